@@ -1,28 +1,133 @@
+import argparse
+import contextlib
+import math
 import os
 import sys
-from sys import argv
+from typing import Optional, Tuple
 
 from polytrackermidi.parsers import patterns, project
-from polytrackermidi.exporters import midi
+from polytrackermidi.exporters import batch, cache, midi
 
 
-def print_usage(message="", exit_program=True, exit_code=1):
+def parse_range(value: str, convert=int) -> Tuple[Optional[float], Optional[float]]:
+    """
+    Parses range command line argument like "3..8".
+    Any end of the range can be omitted, e.g. "3.." or "..8"
+    :return: (start, end) tuple, omitted values are None
+    """
+    if ".." not in value:
+        raise argparse.ArgumentTypeError(f"expected range like START..END, got '{value}'")
 
-    if message:
-        print(message)
-    print(f"Converts polyend tracker *.mtp pattern files to midi files"
-          f"Usage:"            
-          f"\npython {argv[0]} <input_filename.mtp> [<output_filename.mid>]")
-    if exit_program:
-        sys.exit(exit_code)
+    start, end = value.split("..", 1)
+    try:
+        return (convert(start) if start else None,
+                convert(end) if end else None)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid range '{value}'")
+
+
+def create_common_argument_parser() -> argparse.ArgumentParser:
+    """:return: parser of export options shared by single file and batch conversion"""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed of random arps, exports with the same seed have the same random arps")
+    parser.add_argument("--cache-dir", default=None,
+                        help="folder to cache rendered patterns in, so patterns "
+                             "that did not change since the previous export are not rendered again")
+    parser.add_argument("--cache-size", type=int, default=cache.DEFAULT_MAX_SIZE // (1024 * 1024), metavar="MB",
+                        help="cache size limit in megabytes, least recently used patterns are removed "
+                             "when cache grows bigger (default: %(default)s)")
+    return parser
+
+
+def create_argument_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        parents=[create_common_argument_parser()],
+        description="Converts polyend tracker *.mtp pattern files and projects to midi files",
+        epilog="Use '%(prog)s batch --help' to see how to convert many files at once")
+    parser.add_argument("input_filename",
+                        help="*.mtp pattern file, *.mt project file or project folder")
+    parser.add_argument("output_filename", nargs="?",
+                        help="midi file to write, next to input file by default. "
+                             "Use - to write midi to stdout")
+    parser.add_argument("--slots", type=parse_range, metavar="FIRST..LAST",
+                        help="export only song slots from FIRST to LAST (1-based, inclusive), e.g. 3..8")
+    parser.add_argument("--time", type=lambda value: parse_range(value, convert=float), metavar="START..END",
+                        help="export only part of the song from START to END seconds, e.g. 30..60.5")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes to render project song on (default: 1)")
+    return parser
+
+
+def create_batch_argument_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        parents=[create_common_argument_parser()],
+        prog=f"{os.path.basename(sys.argv[0])} batch",
+        description="Converts many polyend tracker pattern files and projects "
+                    "to midi files at once on multiple processes")
+    parser.add_argument("paths", nargs="+",
+                        help="*.mtp pattern files, *.mt project files, project folders "
+                             "or folders to search for them in")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes, number of CPUs by default")
+    parser.add_argument("--chunksize", type=int, default=1,
+                        help="number of files sent to a worker process at once (default: 1)")
+    parser.add_argument("--output-dir", default=None,
+                        help="folder to write midi files to (folder structure is kept), "
+                             "next to input files by default")
+    parser.add_argument("--no-patterns", action="store_true",
+                        help="do not export patterns of projects to separate midi files")
+    return parser
+
+
+def create_disk_cache(args) -> Optional[cache.DiskCache]:
+    if args.cache_dir is None:
+        return None
+    return cache.DiskCache(args.cache_dir, max_size=args.cache_size * 1024 * 1024)
+
+
+def batch_main(arguments: list):
+    parser = create_batch_argument_parser()
+    args = parser.parse_args(arguments)
+
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers should be at least 1")
+    if args.chunksize < 1:
+        parser.error("--chunksize should be at least 1")
+
+    converter = batch.BatchConverter(workers=args.workers, chunksize=args.chunksize,
+                                     export_patterns=not args.no_patterns, output_folder=args.output_dir,
+                                     seed=args.seed, disk_cache=create_disk_cache(args))
+
+    # results are printed as soon as files are converted
+    for result in converter.run(args.paths):
+        print(result)
+
+    print(f"Batch conversion finished. {converter.report}")
+
+    if converter.report.failed_count:
+        sys.exit(1)
 
 
 def main():
+    # a project folder (or file) named "batch" is still exported as usual
+    if len(sys.argv) > 1 and sys.argv[1] == "batch" and not os.path.exists(sys.argv[1]):
+        batch_main(sys.argv[2:])
+        return
+
     # handle commandline args
-    if len(argv) < 2:
-        print_usage("Please provide a name of polyend tracker pattern file to parse")
+    parser = create_argument_parser()
+    args = parser.parse_args()
+
+    if args.slots and args.time:
+        parser.error("--slots and --time can't be used together")
+
+    if args.workers < 1:
+        parser.error("--workers should be at least 1")
+
+    disk_cache = create_disk_cache(args)
 
-    input_filename = argv[1]
+    input_filename = args.input_filename
 
     # generate output filename from an input one by changing extension
     # if provided
@@ -37,35 +142,105 @@ def main():
     else:
         output_filename = ".".join(input_filename.split(".")[:-1]) + ".mid"
 
-    try:
-        # try to get output filename from second command line argument
-        output_filename = argv[2]
+    if args.output_filename:
+        output_filename = args.output_filename
 
         if output_filename.endswith(".mtp"):
             print(f"Are you sure you want to write output {output_filename}? It's an *.mtp file. Output is *.mid")
             sys.exit(1)
-    except IndexError:
-        # not provided - use default one
-        pass
 
     if not (os.path.isfile(input_filename) or os.path.isdir(input_filename)):
         print(f"File {input_filename} does not exist")
         sys.exit(1)
 
-    if os.path.isfile(output_filename):
+    if output_filename == "-":
+        # midi data goes to stdout, so status messages go to stderr
+        midi_output = sys.stdout.buffer
+        with contextlib.redirect_stdout(sys.stderr):
+            export(input_filename, output_filename, midi_output=midi_output, slots=args.slots,
+                   time_range=args.time, workers=args.workers, seed=args.seed, disk_cache=disk_cache)
+            if disk_cache is not None:
+                print(f"Rendered patterns {disk_cache}")
+    else:
+        export(input_filename, output_filename, slots=args.slots, time_range=args.time, workers=args.workers,
+               seed=args.seed, disk_cache=disk_cache)
+        if disk_cache is not None:
+            print(f"Rendered patterns {disk_cache}")
+
+
+def get_song_steps_range(song: project.Song, slots: tuple = None, time_range: tuple = None) -> Tuple[int, int]:
+    """
+    Converts slots range (1-based, inclusive) or time range (in seconds)
+    to a range of song steps, see SongToMidiExporter
+    """
+    if slots:
+        first_slot, last_slot = slots
+        slots_count = len(song.pattern_chain)
+        if first_slot is None:
+            first_slot = 1
+        if last_slot is None:
+            last_slot = slots_count
+        if not 1 <= first_slot <= last_slot <= slots_count:
+            print(f"Invalid slots range {first_slot}..{last_slot}, song has {slots_count} slots")
+            sys.exit(1)
+        return song.get_song_step(first_slot - 1), song.get_song_step(last_slot)
+
+    start_time, end_time = time_range
+    song_duration = song.get_time_at_song_step(song.get_length_in_steps())
+    if start_time is None:
+        start_time = 0
+    # end of the range may be past the end of the song, the rest of the song is exported then
+    if not 0 <= start_time < song_duration or (end_time is not None and end_time <= start_time):
+        end = f"{end_time:g}" if end_time is not None else ""
+        print(f"Invalid time range {start_time:g}..{end}, song is {song_duration:g} seconds long")
+        sys.exit(1)
+
+    start_step = song.get_song_step_at_time(start_time)
+    end_step = None
+    if end_time is not None:
+        # step that is only partially within time range is exported, too
+        end_step = math.ceil(round(end_time / song.get_step_duration(), 6))
+    return start_step, end_step
+
+
+def export(input_filename: str, output_filename: str, midi_output=None,
+           slots: tuple = None, time_range: tuple = None, workers: int = 1, seed: int = None,
+           disk_cache: cache.DiskCache = None):
+    """
+    :param input_filename: pattern file or project file or folder
+    :param output_filename: midi file to write
+    :param midi_output: binary file-like object to stream midi to instead of output file
+    (individual patterns of a project are not exported in this case)
+    :param slots: export only song slots (first, last) range (1-based, inclusive)
+    :param time_range: export only part of the song (start, end) in seconds
+    :param workers: number of processes to render project song on
+    :param seed: seed of random arps, see arps.make_seed()
+    :param disk_cache: on-disk cache of rendered patterns
+    """
+    is_song_part = bool(slots or time_range)
+    if midi_output is None and os.path.isfile(output_filename):
         print(f"File {output_filename} already exists - will overwrite")
 
     if input_filename.endswith(".mtp"):
+        if is_song_part:
+            print("--slots and --time can only be used when exporting projects")
+            sys.exit(1)
+
         print("Trying to parse a pattern file...")
         p = patterns.PatternParser(filename=input_filename)
         parsed_pattern = p.parse()
 
         # print(parsed_pattern.render_as_table())
+        print(f"Pattern {parsed_pattern.get_summary()}")
 
-        midi_exporter = midi.PatternToMidiExporter(pattern=parsed_pattern)
-        midi_exporter.write_midi_file(output_filename)
+        midi_exporter = midi.PatternToMidiExporter(pattern=parsed_pattern, seed=seed, disk_cache=disk_cache)
 
-        print(f"Exported pattern midi to {os.path.abspath(output_filename)}")
+        if midi_output is not None:
+            midi_exporter.write_midi(midi_output)
+            print("Exported pattern midi to stdout")
+        else:
+            midi_exporter.write_midi_file(output_filename)
+            print(f"Exported pattern midi to {os.path.abspath(output_filename)}")
 
     else:
         print("Trying to parse a project...")
@@ -75,35 +250,44 @@ def main():
 
         # print(parsed_pattern.render_as_table())
 
-        midi_exporter = midi.SongToMidiExporter(song=parsed_project.song)
-        midi_exporter.write_midi_file(output_filename)
-
-        print(f"Exported project midi to {os.path.abspath(output_filename)}")
-
-        # todo: export individual patterns, too
-
-        print("Trying to export patterns...")
-
-        for number, pattern in parsed_project.song.pattern_mapping.items():
-            midi_exporter = midi.PatternToMidiExporter(pattern=pattern, tempo_bpm=int(parsed_project.song.bpm))
-
-            number_string = str(number)
-            if len(number_string) < 2:
-                number_string = "0" + number_string
-
-            # create directory for patterns
-            # in the same folder we export project to
-            out_folder = os.sep.join(output_filename.split(os.sep)[:-1]) + os.sep
-
-            try:
-                os.mkdir(out_folder + "patterns_midi/")
-            except FileExistsError:
-                pass
-
-            pattern_output_filename = out_folder + "patterns_midi/" + f"pattern_{number_string}.mid"
-            midi_exporter.write_midi_file(pattern_output_filename)
-            print(f"Exported pattern midi to {os.path.abspath(pattern_output_filename)}")
-
+        song = parsed_project.song
+
+        if is_song_part:
+            start_step, end_step = get_song_steps_range(song, slots=slots, time_range=time_range)
+            print(f"Exporting song steps {start_step}..{end_step if end_step is not None else 'end'}")
+            midi_exporter = midi.SongToMidiExporter(song=song, start_step=start_step, end_step=end_step,
+                                                    workers=workers, seed=seed, disk_cache=disk_cache)
+        else:
+            midi_exporter = midi.SongToMidiExporter(song=song, workers=workers, seed=seed, disk_cache=disk_cache)
+
+        if midi_output is not None:
+            midi_exporter.write_midi(midi_output)
+            print("Exported project midi to stdout")
+            return
+
+        if is_song_part:
+            # only the requested part of the song is exported
+            midi_exporter.write_midi_file(output_filename)
+            print(f"Exported project midi to {os.path.abspath(output_filename)}")
+            return
+
+        export_project(song, output_filename, workers=workers, seed=seed, disk_cache=disk_cache)
+
+
+def export_project(song: project.Song, output_filename: str, workers: int = 1, seed: int = None,
+                   disk_cache: cache.DiskCache = None):
+    """
+    Exports song and all of the project patterns to separate midi files,
+    see midi.export_project()
+    """
+    for number, pattern, exported_filename in midi.export_project(song, output_filename, workers=workers,
+                                                                  seed=seed, disk_cache=disk_cache):
+        if number is None:
+            print(f"Exported project midi to {os.path.abspath(exported_filename)}")
+            print("Exporting patterns...")
+        else:
+            print(f"Pattern {number} {pattern.get_summary()}")
+            print(f"Exported pattern midi to {os.path.abspath(exported_filename)}")
 
 
 if __name__ == '__main__':
@@ -3,6 +3,7 @@ import sys
 from sys import argv
 
 from polytrackermidi.parsers import patterns
+from polytrackermidi.exporters.text import PatternToTextExporter
 
 
 def print_usage(message="", exit_program=True, exit_code=1):
@@ -11,17 +12,21 @@ def print_usage(message="", exit_program=True, exit_code=1):
         print(message)
     print(f"Converts polyend tracker *.mtp pattern files to text table files"
           f"Usage:"            
-          f"\npython {argv[0]} <input_filename.mtp> [<output_filename.txt>]")
+          f"\npython {argv[0]} <input_filename.mtp> [<output_filename.txt>] [--notes]"
+          f"\n--notes lists played notes (with chords and arps) instead of a step table")
     if exit_program:
         sys.exit(exit_code)
 
 
 def main():
     # handle commandline args
-    if len(argv) < 2:
+    list_notes = "--notes" in argv
+    args = [arg for arg in argv if arg != "--notes"]
+
+    if len(args) < 2:
         print_usage("Please provide a name of polyend tracker pattern file to parse")
 
-    input_filename = argv[1]
+    input_filename = args[1]
 
     # generate output filename from an input one by changing extension
     # if provided
@@ -29,7 +34,7 @@ def main():
 
     try:
         # try to get output filename from second command line argument
-        output_filename = argv[2]
+        output_filename = args[2]
 
         if output_filename.endswith(".mtp"):
             print(f"Are you sure you want to write output {output_filename}? It's an *.mtp file. Output is *.txt")
@@ -48,14 +53,10 @@ def main():
     p = patterns.PatternParser(filename=input_filename)
     parsed_pattern = p.parse()
 
-    result = parsed_pattern.render_as_table()
-
-    with open(output_filename, 'w') as out:
-        out.write(result)
-
-
+    exporter = PatternToTextExporter(pattern=parsed_pattern, list_notes=list_notes)
+    exporter.write_text_file(output_filename)
 
-    print(f"Exported text table to {os.path.abspath(output_filename)}")
+    print(f"Exported text {'notes list' if list_notes else 'table'} to {os.path.abspath(output_filename)}")
 
 
 if __name__ == '__main__':
@@ -1 +1 @@
-__all__ = ['midi']
\ No newline at end of file
+__all__ = ['batch', 'cache', 'midi', 'optimizer', 'smf', 'text']
\ No newline at end of file
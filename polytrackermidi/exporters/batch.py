@@ -0,0 +1,345 @@
+# Converts many pattern files and projects at once on multiple processes
+
+__author__ = "Alexey 'DataGreed' Strelkov"
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterable, Iterator, List
+
+from polytrackermidi.parsers import patterns, project
+from polytrackermidi.exporters import midi
+from polytrackermidi.exporters.cache import DiskCache
+
+PATTERN_FILE_EXTENSION = ".mtp"
+PROJECT_FILE_EXTENSION = ".mt"
+
+
+class BatchJob:
+    """
+    A single pattern file or project to convert
+    """
+
+    def __init__(self, input_path: str, output_filename: str, export_patterns: bool = True, seed: int = None,
+                 disk_cache: DiskCache = None):
+        """
+        :param input_path: *.mtp pattern file, *.mt project file or project folder
+        :param output_filename: midi file to write
+        :param export_patterns: also export every pattern of a project to a separate
+        midi file in patterns_midi folder next to the song midi file (same as the cli tool does)
+        :param seed: seed of random arps, see arps.make_seed()
+        :param disk_cache: on-disk cache of rendered patterns
+        """
+        self.input_path = input_path
+        self.output_filename = output_filename
+        self.export_patterns = export_patterns
+        self.seed = seed
+        self.disk_cache = disk_cache
+
+        # input that is exported to the same midi files, job is not converted if set
+        self.conflicting_input_path: str = None
+
+    def is_pattern(self) -> bool:
+        return self.input_path.endswith(PATTERN_FILE_EXTENSION)
+
+    def get_patterns_folder(self) -> str:
+        """:return: folder patterns of a project are exported to"""
+        return midi.get_patterns_folder(self.output_filename)
+
+    def get_output_paths(self) -> List[str]:
+        """:return: midi file and folder (with patterns of a project) the job writes to"""
+        if self.export_patterns and not self.is_pattern():
+            return [self.output_filename, self.get_patterns_folder()]
+        return [self.output_filename]
+
+    def __str__(self):
+        return self.input_path
+
+
+class BatchResult:
+    """
+    Outcome of a single conversion. Conversion errors are stored
+    instead of being raised, so one broken file does not stop the batch
+    """
+
+    def __init__(self, job: BatchJob, output_files: List[str] = None, error: str = None, seconds: float = 0):
+        """
+        :param job: converted job
+        :param output_files: midi files that were written
+        :param error: error message if conversion failed, None if it succeeded
+        :param seconds: time conversion took
+        """
+        self.job = job
+        self.output_files = output_files or []
+        self.error = error
+        self.seconds = seconds
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __str__(self):
+        if not self.ok:
+            return f"Failed to convert {self.job.input_path}: {self.error}"
+        return f"Exported {self.job.input_path} to {self.job.output_filename} " \
+               f"({len(self.output_files)} midi files, {self.seconds:.2f}s)"
+
+
+class BatchReport:
+    """
+    Overall statistics of a batch conversion
+    """
+
+    def __init__(self):
+        self.converted_count = 0
+        self.output_files_count = 0
+        self.seconds = 0.0
+        # results of conversions that failed, with error messages
+        self.failed_results: List[BatchResult] = []
+
+    def add(self, result: BatchResult):
+        if result.ok:
+            self.converted_count += 1
+            self.output_files_count += len(result.output_files)
+        else:
+            self.failed_results.append(result)
+
+    @property
+    def failed_count(self) -> int:
+        return len(self.failed_results)
+
+    @property
+    def files_count(self) -> int:
+        """number of processed input files and project folders"""
+        return self.converted_count + self.failed_count
+
+    @property
+    def files_per_second(self) -> float:
+        if not self.seconds:
+            return 0.0
+        return self.files_count / self.seconds
+
+    def __str__(self):
+        return (f"converted: {self.converted_count}, failed: {self.failed_count}, "
+                f"midi files written: {self.output_files_count}, time: {self.seconds:.2f}s, "
+                f"{self.files_per_second:.1f} files/sec")
+
+
+def is_project_folder(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, project.ProjectParser.DEFAULT_PROJECT_FILENAME))
+
+
+def find_inputs(path: str) -> Iterator[str]:
+    """
+    Walks folder and finds everything that can be converted: project folders,
+    *.mt project files and *.mtp pattern files that are not a part of a project.
+    Folders are walked in alphabetical order, project folders are not walked into.
+    :param path: folder to walk, files and project folders are returned as is
+    :return: paths of pattern files, project files and project folders
+    """
+    if not os.path.isdir(path) or is_project_folder(path):
+        yield path
+        return
+
+    for folder, folder_names, file_names in os.walk(path):
+        folder_names.sort()
+
+        # project folders are converted as a whole,
+        # their patterns folders should not be converted once again
+        for folder_name in list(folder_names):
+            subfolder = os.path.join(folder, folder_name)
+            if is_project_folder(subfolder):
+                folder_names.remove(folder_name)
+                yield subfolder
+
+        for file_name in sorted(file_names):
+            if file_name.endswith(PATTERN_FILE_EXTENSION) or file_name.endswith(PROJECT_FILE_EXTENSION):
+                yield os.path.join(folder, file_name)
+
+
+def get_output_filename(input_path: str, output_folder: str = None, root: str = None) -> str:
+    """
+    Generates midi file name for the input the same way the cli tool does:
+    project folders are exported to project.mid inside the folder,
+    files are exported next to them with *.mid extension.
+    :param input_path: pattern file, project file or project folder
+    :param output_folder: folder to write midi files to instead, folder structure
+    of inputs relative to root is recreated in it
+    :param root: folder input was found in, see find_inputs()
+    """
+    if os.path.isdir(input_path):
+        output_filename = os.path.join(input_path, "project.mid")
+    else:
+        output_filename = os.path.splitext(input_path)[0] + ".mid"
+
+    if output_folder is None:
+        return output_filename
+
+    if root is None or not os.path.isdir(root):
+        root = os.path.dirname(input_path)
+    elif is_project_folder(root):
+        # project folder itself is the root, its name is kept, so that
+        # multiple projects exported to the same folder don't overwrite each other
+        root = os.path.dirname(os.path.normpath(root))
+    return os.path.join(output_folder, os.path.relpath(output_filename, root))
+
+
+def convert(job: BatchJob) -> List[str]:
+    """
+    Converts pattern or project to midi files the same way the cli tool does,
+    see midi.export_project()
+    :return: names of written midi files
+    """
+    if job.is_pattern():
+        output_folder = os.path.dirname(job.output_filename)
+        if output_folder:
+            os.makedirs(output_folder, exist_ok=True)
+
+        pattern = patterns.PatternParser(filename=job.input_path).parse()
+        midi.PatternToMidiExporter(pattern=pattern, seed=job.seed,
+                                   disk_cache=job.disk_cache).write_midi_file(job.output_filename)
+        return [job.output_filename]
+
+    song = project.ProjectParser(filename_or_folder=job.input_path).parse().song
+    return [output_filename for number, pattern, output_filename
+            in midi.export_project(song, job.output_filename, export_patterns=job.export_patterns,
+                                   seed=job.seed, disk_cache=job.disk_cache)]
+
+
+def run_job(job: BatchJob) -> BatchResult:
+    """Converts a single job, catches conversion errors"""
+    started = time.perf_counter()
+    try:
+        output_files = convert(job)
+    except Exception as e:
+        return BatchResult(job, error=f"{type(e).__name__}: {e}", seconds=time.perf_counter() - started)
+    return BatchResult(job, output_files=output_files, seconds=time.perf_counter() - started)
+
+
+def run_jobs(jobs: List[BatchJob]) -> List[BatchResult]:
+    """Converts a chunk of jobs in a worker process"""
+    return [run_job(job) for job in jobs]
+
+
+class BatchConverter:
+    """
+    Converts many patterns and projects on a pool of processes.
+    Jobs are sent to worker processes in chunks, so every process
+    pays interpreter start-up once and converts many files.
+
+    Usage:
+        converter = BatchConverter(workers=4)
+        for result in converter.run(["./archive/"]):
+            print(result)
+        print(converter.report)
+    """
+
+    def __init__(self, workers: int = None, chunksize: int = 1, export_patterns: bool = True,
+                 output_folder: str = None, seed: int = None, disk_cache: DiskCache = None):
+        """
+        :param workers: number of worker processes, number of CPUs by default
+        :param chunksize: number of jobs sent to a worker process at once. Bigger
+        chunks mean less inter-process communication, smaller - better load balancing
+        :param export_patterns: also export every pattern of projects to separate midi files
+        :param output_folder: folder to write midi files to instead of writing them
+        next to input files, see get_output_filename()
+        :param seed: seed of random arps, see arps.make_seed()
+        :param disk_cache: on-disk cache of rendered patterns, shared by all worker processes
+        """
+        if chunksize < 1:
+            raise ValueError(f"Chunk size should be at least 1, got {chunksize}")
+
+        self.workers = workers
+        self.chunksize = chunksize
+        self.export_patterns = export_patterns
+        self.output_folder = output_folder
+        self.seed = seed
+        self.disk_cache = disk_cache
+
+        # statistics of the last run
+        self.report = BatchReport()
+
+    def iter_jobs(self, paths: Iterable[str]) -> Iterator[BatchJob]:
+        """
+        :param paths: pattern files, project files, project folders
+        or folders to find them in
+        :return: jobs, jobs that would overwrite midi files of previous jobs
+        have conflicting_input_path set and should not be converted
+        """
+        # output path: input path that is exported to it
+        outputs = {}
+        for root in paths:
+            for input_path in find_inputs(root):
+                job = BatchJob(input_path, get_output_filename(input_path, self.output_folder, root),
+                               export_patterns=self.export_patterns, seed=self.seed,
+                               disk_cache=self.disk_cache)
+
+                output_keys = [os.path.normcase(os.path.abspath(output_path))
+                               for output_path in job.get_output_paths()]
+                for output_key in output_keys:
+                    if output_key in outputs:
+                        job.conflicting_input_path = outputs[output_key]
+                        break
+                else:
+                    for output_key in output_keys:
+                        outputs[output_key] = input_path
+
+                yield job
+
+    def iter_chunks(self, jobs: Iterable[BatchJob]) -> Iterator[List[BatchJob]]:
+        chunk = []
+        for job in jobs:
+            chunk.append(job)
+            if len(chunk) == self.chunksize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def run(self, paths: Iterable[str]) -> Iterator[BatchResult]:
+        """
+        Converts everything that is found in paths.
+        Results (and errors) are yielded as soon as they are ready,
+        not in the order of paths. See self.report for overall statistics
+        :param paths: pattern files, project files, project folders
+        or folders to find them in
+        """
+        self.report = BatchReport()
+        started = time.perf_counter()
+
+        jobs = []
+        for job in self.iter_jobs(paths):
+            if job.conflicting_input_path is None:
+                jobs.append(job)
+                continue
+
+            # midi files of another input are never overwritten
+            result = BatchResult(job, error=f"would overwrite midi files exported from "
+                                            f"{job.conflicting_input_path} in {os.path.dirname(job.output_filename)}")
+            self.report.add(result)
+            yield result
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(run_jobs, chunk) for chunk in self.iter_chunks(jobs)]
+
+            for future in as_completed(futures):
+                for result in future.result():
+                    self.report.add(result)
+                    self.report.seconds = time.perf_counter() - started
+                    yield result
+
+        self.report.seconds = time.perf_counter() - started
+
+
+def convert_all(paths: Iterable[str], workers: int = None, chunksize: int = 1,
+                export_patterns: bool = True, output_folder: str = None, seed: int = None,
+                disk_cache: DiskCache = None) -> BatchReport:
+    """
+    Converts everything that is found in paths, see BatchConverter
+    :return: overall statistics
+    """
+    converter = BatchConverter(workers=workers, chunksize=chunksize, export_patterns=export_patterns,
+                               output_folder=output_folder, seed=seed, disk_cache=disk_cache)
+    for _ in converter.run(paths):
+        pass
+    return converter.report
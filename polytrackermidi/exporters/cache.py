@@ -0,0 +1,235 @@
+# On-disk cache of rendered midi events of patterns
+
+__author__ = "Alexey 'DataGreed' Strelkov"
+
+import hashlib
+import os
+import struct
+import tempfile
+import time
+import zlib
+from typing import Iterator, Optional, Tuple
+
+try:
+    # fcntl is not available on windows. Cache still works without it,
+    # but concurrent processes may evict entries at the same time
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# default cache size limit in bytes
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+# eviction is checked on the first write and then every time
+# this part of the size limit is written to the cache
+EVICTION_CHECK_FRACTION = 0.1
+
+# temporary files older than this (in seconds) are left by crashed processes and can be removed
+STALE_TEMP_FILE_SECONDS = 60 * 60
+
+# every entry starts with magic bytes, length and crc32 of the stored data
+ENTRY_MAGIC = b"PTMC"
+ENTRY_HEADER = struct.Struct("<4sII")
+
+
+class DiskCache:
+    """
+    Content-addressed cache of rendered patterns stored in a folder,
+    so patterns that did not change are not rendered again on the next run.
+    Entries are keyed by a hash of pattern bytes and export options (see make_key()),
+    so changed patterns simply get new keys and old entries are evicted eventually.
+
+    Entries are plain bytes (not pickles), so a cache folder shared with other users
+    can't be used to run code. Broken entries are detected with a checksum and treated as missing.
+
+    Safe to share between concurrent processes: entries are written to temporary
+    files and atomically moved in place, so readers never see partially written entries.
+    Least recently used entries (by modification time, which is updated on every hit)
+    are removed when cache grows over size limit. Only one process evicts at a time.
+    """
+
+    FILE_EXTENSION = ".bin"
+    TEMP_FILE_EXTENSION = ".tmp"
+    LOCK_FILENAME = ".lock"
+
+    def __init__(self, folder: str, max_size: int = DEFAULT_MAX_SIZE):
+        """
+        :param folder: cache folder, created if it does not exist
+        :param max_size: cache size limit in bytes
+        """
+        self.folder = folder
+        self.max_size = max_size
+
+        # statistics of this cache instance
+        self.hits = 0
+        self.misses = 0
+
+        # bytes written since the last eviction check
+        self._written_size = 0
+        # size limit is checked on the first write of every instance, so it is applied
+        # across runs too, even if a single run never writes much to the cache
+        self._evicted = False
+
+        os.makedirs(folder, exist_ok=True)
+
+    def __reduce__(self):
+        # statistics are not shared between processes
+        return DiskCache, (self.folder, self.max_size)
+
+    @staticmethod
+    def make_key(data: bytes, *options) -> str:
+        """
+        :param data: bytes the cached value is rendered from, e.g. pattern payload
+        :param options: anything else the cached value depends on (exporter version, export options)
+        """
+        digest = hashlib.sha256(data)
+        digest.update(repr(options).encode())
+        return digest.hexdigest()
+
+    def get_path(self, key: str) -> str:
+        # entries are spread over subfolders, so no folder gets too big
+        return os.path.join(self.folder, key[:2], key + DiskCache.FILE_EXTENSION)
+
+    def load(self, key: str) -> Optional[bytes]:
+        """
+        :return: cached data or None if there is no such entry
+        """
+        path = self.get_path(key)
+        try:
+            with open(path, "rb") as cache_file:
+                entry = cache_file.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        data = self.unpack_entry(entry)
+        if data is None:
+            # broken entry (e.g. written by an incompatible version) is treated as missing
+            self.misses += 1
+            self._remove(path)
+            return None
+
+        try:
+            # entry was recently used, so it is evicted last
+            os.utime(path)
+        except OSError:
+            # entry was evicted by another process in the meantime, data is still fine
+            pass
+
+        self.hits += 1
+        return data
+
+    def store(self, key: str, data: bytes):
+        path = self.get_path(key)
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+
+        # written to a temporary file first, so other processes never read
+        # partially written entries. Moving a file is atomic
+        entry = self.pack_entry(data)
+        file_descriptor, temp_path = tempfile.mkstemp(dir=folder, suffix=DiskCache.TEMP_FILE_EXTENSION)
+        try:
+            with os.fdopen(file_descriptor, "wb") as temp_file:
+                temp_file.write(entry)
+            os.replace(temp_path, path)
+        except BaseException:
+            self._remove(temp_path)
+            raise
+
+        self._written_size += len(entry)
+        if not self._evicted or self._written_size >= self.max_size * EVICTION_CHECK_FRACTION:
+            self.evict()
+
+    @staticmethod
+    def pack_entry(data: bytes) -> bytes:
+        return ENTRY_HEADER.pack(ENTRY_MAGIC, len(data), zlib.crc32(data)) + data
+
+    @staticmethod
+    def unpack_entry(entry: bytes) -> Optional[bytes]:
+        """:return: data stored in entry or None if entry is broken"""
+        if len(entry) < ENTRY_HEADER.size:
+            return None
+        magic, length, checksum = ENTRY_HEADER.unpack_from(entry)
+        data = entry[ENTRY_HEADER.size:]
+        if magic != ENTRY_MAGIC or length != len(data) or checksum != zlib.crc32(data):
+            return None
+        return data
+
+    def iter_entries(self) -> Iterator[Tuple[str, int, float]]:
+        """
+        :return: (path, size in bytes, modification time) tuples of all entries
+        """
+        for subfolder in os.scandir(self.folder):
+            if not subfolder.is_dir():
+                continue
+            for entry in os.scandir(subfolder.path):
+                if not entry.name.endswith(DiskCache.FILE_EXTENSION):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def get_size(self) -> int:
+        """:return: total size of entries in bytes"""
+        return sum(size for path, size, modified in self.iter_entries())
+
+    def evict(self):
+        """
+        Removes least recently used entries until cache fits into size limit.
+        Does nothing if another process is evicting entries at the moment.
+        """
+        self._written_size = 0
+        self._evicted = True
+
+        with open(os.path.join(self.folder, DiskCache.LOCK_FILENAME), "a") as lock_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # another process is already evicting
+                    return
+
+            try:
+                self._remove_stale_temp_files()
+
+                entries = list(self.iter_entries())
+                size = sum(entry[1] for entry in entries)
+                if size <= self.max_size:
+                    return
+
+                # oldest first
+                entries.sort(key=lambda entry: entry[2])
+                for path, entry_size, modified in entries:
+                    if size <= self.max_size:
+                        break
+                    self._remove(path)
+                    size -= entry_size
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _remove_stale_temp_files(self):
+        now = time.time()
+        for subfolder in os.scandir(self.folder):
+            if not subfolder.is_dir():
+                continue
+            for entry in os.scandir(subfolder.path):
+                if not entry.name.endswith(DiskCache.TEMP_FILE_EXTENSION):
+                    continue
+                try:
+                    if now - entry.stat().st_mtime > STALE_TEMP_FILE_SECONDS:
+                        self._remove(entry.path)
+                except FileNotFoundError:
+                    continue
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def __str__(self):
+        return f"cache {self.folder}: {self.hits} hits, {self.misses} misses"
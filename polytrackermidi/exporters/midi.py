@@ -1,51 +1,407 @@
-from typing import Optional
-
-from polytrackermidi.parsers.patterns import Pattern, Note
-from midiutil import MIDIFile
-
-from polytrackermidi.parsers.project import Song
+import heapq
+import os
+import random
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from polytrackermidi.parsers import arps
+from polytrackermidi.parsers.patterns import Pattern, PatternSummary, Note
+from polytrackermidi.exporters import optimizer
+from polytrackermidi.exporters.cache import DiskCache
+from polytrackermidi.exporters.smf import StandardMidiFile, TICKS_PER_QUARTER_NOTE, ORDER_NOTE_ON, \
+    ORDER_NOTE_OFF, ORDER_CONTROL, EncodedFragment, note_on_message, note_off_message, control_change_message, \
+    tempo_message, track_name_message, write_midi_stream
+
+from polytrackermidi.parsers.project import Project, Song
+
+# folder that patterns of a project are exported to, next to the song midi file
+PATTERNS_MIDI_FOLDER_NAME = "patterns_midi"
+
+# version of rendered midi events. Should be increased whenever rendering
+# changes, so events cached on disk by previous versions are not used
+EXPORTER_VERSION = 1
+
+# number of instruments and instrument number in packed pattern track fragments
+FRAGMENTS_COUNT = struct.Struct("<H")
+FRAGMENT_INSTRUMENT = struct.Struct("<H")
+
+
+def pack_track_fragments(pattern_track_fragments: Dict[int, EncodedFragment]) -> bytes:
+    """
+    :param pattern_track_fragments: instrument number: encoded fragment,
+    see BaseMidiExporter.get_pattern_track_fragments()
+    :return: fragments as plain bytes (e.g. to store them on disk), see unpack_track_fragments()
+    """
+    parts = [FRAGMENTS_COUNT.pack(len(pattern_track_fragments))]
+    for instrument_number, fragment in pattern_track_fragments.items():
+        parts.append(FRAGMENT_INSTRUMENT.pack(instrument_number))
+        parts.append(fragment.to_bytes())
+    return b"".join(parts)
+
+
+def unpack_track_fragments(data: bytes) -> Dict[int, EncodedFragment]:
+    """
+    Reads fragments written by pack_track_fragments()
+    :raises ValueError: if data is broken
+    """
+    try:
+        count, = FRAGMENTS_COUNT.unpack_from(data)
+        offset = FRAGMENTS_COUNT.size
+        pattern_track_fragments = {}
+        for _ in range(count):
+            instrument_number, = FRAGMENT_INSTRUMENT.unpack_from(data, offset)
+            pattern_track_fragments[instrument_number], offset = \
+                EncodedFragment.from_bytes(data, offset + FRAGMENT_INSTRUMENT.size)
+    except struct.error as e:
+        raise ValueError(f"Broken pattern track fragments: {e}")
+
+    if offset != len(data):
+        raise ValueError(f"Broken pattern track fragments: {len(data) - offset} unexpected bytes at the end")
+    return pattern_track_fragments
 
 
 class BaseMidiExporter:
     """Base class for all midi exporters"""
 
-    # midi utils uses either ticks of beats (quarter notes) as time
+    # midi file uses either ticks of beats (quarter notes) as time
     # beats are expressed in floats
     # tracker uses 1/16 of s note
-    # so this value is a tracker step duration to use with MIDIUtil
+    # so this value is a tracker step duration in beats
     MIDI_16TH_NOTE_TIME_VALUE = 0.25
 
-    # def generate_midi(self) -> MIDIFile:
+    # def generate_midi(self) -> StandardMidiFile:
     #     raise NotImplementedError()
 
-    def write_midi_file(self, path: str):
+    # all notes are written to the first midi channel
+    MIDI_CHANNEL = 0
+
+    # midi pitches are 7 bit
+    MIDI_MAX_PITCH = 127
+
+    # number of semitones to transpose all the notes by
+    transpose = 0
+
+    # clean up notes before writing them (see optimizer.optimize_notes())
+    optimize = True
+
+    # seed of random arps, see arps.get_step_random()
+    seed = arps.DEFAULT_SEED
+
+    # on-disk cache of rendered patterns, shared between runs
+    disk_cache: DiskCache = None
+
+    def get_tempo_bpm(self) -> float:
+        raise NotImplementedError()
+
+    def get_list_of_instruments(self) -> List[int]:
+        raise NotImplementedError()
+
+    def iter_slots(self, ticks_per_step: int) -> Iterator[Tuple[Pattern, int, int, int]]:
+        """
+        Iterates over patterns in the order they are played
+        :return: (pattern, pattern start time in ticks, start tick, end tick) tuples.
+        Only the part of the pattern from start tick to end tick
+        (relative to the pattern start) is played.
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def iter_pattern_notes(pattern: Pattern, ticks_per_step: int, from_tick: int = 0, to_tick: int = None,
+                           transpose: int = 0, seed: int = arps.DEFAULT_SEED,
+                           max_pitch: int = MIDI_MAX_PITCH) -> Iterator[tuple]:
+        """
+        Iterates over compiled notes of the pattern that play between from_tick and to_tick
+        (relative to the pattern start). Notes that play only partially are cut.
+        Notes out of midi pitch range (e.g. chords on high notes) are skipped.
+        :param transpose: number of semitones to transpose notes by. Notes that
+        get out of midi pitch range after transposition are skipped, too.
+        :param seed: seed of random arps
+        :param max_pitch: notes above this pitch (before transposition) are skipped
+        :return: (track, instrument, pitch, start tick, duration, velocity) tuples, see NoteEventTable
+        """
+        note_events = pattern.get_note_events(ticks_per_step, seed)
+
+        if transpose:
+            for track_number, instrument_number, pitch, start_tick, duration, velocity \
+                    in BaseMidiExporter.iter_pattern_notes(pattern, ticks_per_step, from_tick, to_tick, seed=seed,
+                                                           max_pitch=BaseMidiExporter.MIDI_MAX_PITCH - transpose):
+                pitch += transpose
+                if pitch >= 0:
+                    yield track_number, instrument_number, pitch, start_tick, duration, velocity
+            return
+
+        if to_tick is None:
+            to_tick = note_events.length_ticks
+
+        if from_tick <= 0 and to_tick >= note_events.length_ticks:
+            # whole pattern, notes never play longer than the pattern
+            for note in note_events:
+                if note[2] <= max_pitch:
+                    yield note
+            return
+
+        for track_number, instrument_number, pitch, start_tick, duration, velocity in note_events:
+            end_tick = start_tick + duration
+            if end_tick <= from_tick or start_tick >= to_tick or pitch > max_pitch:
+                continue
+            start_tick = max(start_tick, from_tick)
+            yield track_number, instrument_number, pitch, start_tick, min(end_tick, to_tick) - start_tick, velocity
+
+    def get_pattern_instrument_notes(self, pattern: Pattern, ticks_per_step: int,
+                                     from_tick: int = 0, to_tick: int = None) -> Dict[int, List[tuple]]:
+        """
+        Groups compiled notes of the pattern (or its part, see iter_pattern_notes())
+        by instrument, i.e. by midi track, and cleans them up with optimizer
+        :return: instrument number: list of (midi pitch, start tick, end tick, velocity) tuples
+        """
+        notes_by_instrument = {}
+        for track_number, instrument_number, pitch, start_tick, duration, velocity \
+                in self.iter_pattern_notes(pattern, ticks_per_step, from_tick, to_tick, self.transpose, self.seed):
+            notes = notes_by_instrument.get(instrument_number)
+            if notes is None:
+                notes = notes_by_instrument[instrument_number] = []
+            notes.append((pitch, start_tick, start_tick + duration, velocity))
+
+        if self.optimize:
+            # notes never play longer than pattern, so notes
+            # of different patterns can't overlap and can be optimized separately
+            for instrument_number, notes in notes_by_instrument.items():
+                notes_by_instrument[instrument_number] = optimizer.optimize_notes(notes)
+
+        return notes_by_instrument
+
+    @staticmethod
+    def iter_pattern_controls(pattern: Pattern, ticks_per_step: int, from_tick: int = 0, to_tick: int = None,
+                              seed: int = arps.DEFAULT_SEED) -> Iterator[tuple]:
+        """
+        Iterates over compiled automation of the pattern that is set between from_tick
+        and to_tick (relative to the pattern start). Values set before from_tick are
+        moved to from_tick, so the part of the pattern sounds the same as it does
+        when the whole pattern is played.
+        :param seed: seed of random arps (automation does not depend on it,
+        but notes and automation are compiled to the same table)
+        :return: (track, instrument, controller, tick, value) tuples ordered by tick, see NoteEventTable
+        """
+        note_events = pattern.get_note_events(ticks_per_step, seed)
+        if to_tick is None:
+            to_tick = note_events.length_ticks
+
+        for track_number, instrument_number, controller, tick, value in sorted(
+                note_events.iter_controls(), key=lambda control: control[3]):
+            if tick >= to_tick:
+                break
+            yield track_number, instrument_number, controller, max(tick, from_tick), value
+
+    def get_pattern_instrument_controls(self, pattern: Pattern, ticks_per_step: int,
+                                        from_tick: int = 0, to_tick: int = None) -> Dict[int, List[tuple]]:
+        """
+        Groups compiled automation of the pattern (or its part, see iter_pattern_controls())
+        by instrument, i.e. by midi track. Repeated values are dropped with optimizer
+        :return: instrument number: list of (tick, controller, value) tuples
+        """
+        controls_by_instrument = {}
+        for track_number, instrument_number, controller, tick, value \
+                in self.iter_pattern_controls(pattern, ticks_per_step, from_tick, to_tick, self.seed):
+            controls = controls_by_instrument.get(instrument_number)
+            if controls is None:
+                controls = controls_by_instrument[instrument_number] = []
+            controls.append((tick, controller, value))
+
+        for instrument_number, controls in controls_by_instrument.items():
+            controls_by_instrument[instrument_number] = optimizer.optimize_controls(controls)
+
+        return controls_by_instrument
+
+    def get_fragments_cache_key(self, pattern: Pattern, ticks_per_step: int) -> tuple:
+        """:return: key of rendered whole pattern in events cache, see get_pattern_track_fragments()"""
+        # transposed notes (and notes with other random arps seed) are cached separately,
+        # the rest of the variants of the same song (other tempo, repetitions) share the same events
+        return pattern, ticks_per_step, self.transpose, self.optimize, self.seed
+
+    def get_pattern_track_fragments(self, pattern: Pattern, ticks_per_step: int,
+                                    from_tick: int = 0, to_tick: int = None) -> Dict[int, EncodedFragment]:
+        """
+        Converts compiled notes and automation of the pattern to midi note on, note off
+        and control change events grouped by instrument. Events of every instrument are sorted and encoded once and cached,
+        so a pattern that is played multiple times (or exported to a song and a pattern file)
+        is only processed once (parts of patterns are not cached). If exporter has a disk cache,
+        whole patterns are also looked up there by pattern bytes and export options, so patterns
+        that did not change since the previous export are not rendered at all.
+        :return: instrument number: encoded fragment with events of the instrument,
+        ticks are relative to the pattern start
+        """
+        whole_pattern = from_tick <= 0 and (to_tick is None or to_tick >= pattern.tracks[0].length * ticks_per_step)
+
+        key = self.get_fragments_cache_key(pattern, ticks_per_step)
+        disk_key = None
+        if whole_pattern:
+            pattern_track_fragments = self._pattern_track_fragments.get(key)
+            if pattern_track_fragments is not None:
+                return pattern_track_fragments
+
+            if self.disk_cache is not None:
+                disk_key = DiskCache.make_key(pattern.to_bytes(), EXPORTER_VERSION, ticks_per_step,
+                                              self.transpose, self.optimize, self.seed)
+                data = self.disk_cache.load(disk_key)
+                if data is not None:
+                    try:
+                        pattern_track_fragments = unpack_track_fragments(data)
+                    except ValueError:
+                        # broken entry, pattern is rendered again and the entry is overwritten
+                        pass
+                    else:
+                        self._pattern_track_fragments[key] = pattern_track_fragments
+                        return pattern_track_fragments
+
+        channel = BaseMidiExporter.MIDI_CHANNEL
+        events_by_instrument = {}
+        # same ordering as in StandardMidiFile, so both produce the same files
+        for instrument_number, notes in self.get_pattern_instrument_notes(pattern, ticks_per_step,
+                                                                          from_tick, to_tick).items():
+            events = events_by_instrument.setdefault(instrument_number, [])
+            for pitch, start_tick, end_tick, velocity in notes:
+                events.append((start_tick, ORDER_NOTE_ON, pitch, note_on_message(channel, pitch, velocity)))
+                events.append((end_tick, ORDER_NOTE_OFF, pitch, note_off_message(channel, pitch)))
+
+        for instrument_number, controls in self.get_pattern_instrument_controls(pattern, ticks_per_step,
+                                                                                from_tick, to_tick).items():
+            events = events_by_instrument.setdefault(instrument_number, [])
+            for tick, controller, value in controls:
+                events.append((tick, ORDER_CONTROL, controller, control_change_message(channel, controller, value)))
+
+        pattern_track_fragments = {}
+        for instrument_number, events in events_by_instrument.items():
+            events.sort()
+            pattern_track_fragments[instrument_number] = EncodedFragment(
+                [(tick, message) for tick, order, pitch, message in events])
+
+        if whole_pattern:
+            self._pattern_track_fragments[key] = pattern_track_fragments
+            if disk_key is not None:
+                self.disk_cache.store(disk_key, pack_track_fragments(pattern_track_fragments))
+        return pattern_track_fragments
+
+    def iter_track_events(self, instrument_number: int,
+                          ticks_per_quarter_note: int = TICKS_PER_QUARTER_NOTE,
+                          fragments: Iterable[Tuple[int, EncodedFragment]] = None
+                          ) -> Iterator[Tuple[int, Union[bytes, EncodedFragment]]]:
+        """
+        Generates events of instrument midi track slot by slot,
+        ordered by time, without keeping them all in memory.
+        :param fragments: (slot start time in ticks, encoded fragment) tuples of the instrument
+        that are already rendered (e.g. by worker processes), ordered by time.
+        Slots are rendered one by one if not set.
+        :return: (absolute time in ticks, midi message) tuples
+        and (slot start time in ticks, encoded fragment with slot notes) tuples
+        """
+        # todo: get actual track names from project file (or are they stored in instrument files?)
+        # todo: instrument 48 is midi instrument 1 the next 15 are also midi instruments - set their names
+        yield 0, track_name_message(f"Instrument {instrument_number}")
+
+        if fragments is not None:
+            yield from fragments
+            return
+
+        ticks_per_step = int(ticks_per_quarter_note * BaseMidiExporter.MIDI_16TH_NOTE_TIME_VALUE)
+
+        # notes never last longer than pattern they are played in,
+        # so events of every next slot go after the events of the previous one
+        for pattern, start_tick_offset, from_tick, to_tick in self.iter_slots(ticks_per_step):
+            fragment = self.get_pattern_track_fragments(pattern, ticks_per_step, from_tick, to_tick).get(instrument_number)
+            if fragment:
+                yield start_tick_offset, fragment
+
+    def prerender(self, ticks_per_quarter_note: int = TICKS_PER_QUARTER_NOTE):
+        """
+        Renders and encodes midi events of all the patterns that are exported in advance,
+        in the order they are played. Encoded events are cached, so rendered patterns can be
+        written later (e.g. from other threads) without rendering them again.
+        """
+        ticks_per_step = int(ticks_per_quarter_note * BaseMidiExporter.MIDI_16TH_NOTE_TIME_VALUE)
+        for pattern, start_tick_offset, from_tick, to_tick in self.iter_slots(ticks_per_step):
+            self.get_pattern_track_fragments(pattern, ticks_per_step, from_tick, to_tick)
+
+    def get_midi_tracks(self, ticks_per_quarter_note: int = TICKS_PER_QUARTER_NOTE) -> List[Iterable[Tuple[int, bytes]]]:
+        """
+        :return: lazy event iterables of all midi tracks: tempo track
+        followed by a track for every instrument
+        """
+        tracks = [iter([(0, tempo_message(self.get_tempo_bpm()))])]
+        for instrument_number in self.get_list_of_instruments():
+            tracks.append(self.iter_track_events(instrument_number, ticks_per_quarter_note))
+        return tracks
 
-        midi_file = self.generate_midi()
+    def write_midi(self, output: BinaryIO, ticks_per_quarter_note: int = TICKS_PER_QUARTER_NOTE):
+        """
+        Streams midi file to a binary file-like object (can be a pipe or stdout).
+        Events are generated pattern slot by slot and track chunks are written
+        as they are encoded, so memory use does not grow with song length.
+        Writes the same bytes as generate_midi().writeFile()
+        """
+        tracks = self.get_midi_tracks(ticks_per_quarter_note)
+        write_midi_stream(output, tracks, tracks_count=len(tracks), ticks_per_quarter_note=ticks_per_quarter_note)
 
-        with open(path, "wb") as output_file:
-            midi_file.writeFile(output_file)
+    def write_midi_file(self, path: str):
+        """
+        Writes midi file. Tracks are rendered while the file is written, so the file is written
+        under a temporary name next to it first and moved in place only when it's complete:
+        if export fails, an existing file is left untouched and no partial file is left.
+        """
+        tracks = self.get_midi_tracks()
+
+        # unique for every process and thread, so concurrent exports of the same file don't clash
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "wb") as output_file:
+                write_midi_stream(output_file, tracks, tracks_count=len(tracks))
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
 
 
 class PatternToMidiExporter(BaseMidiExporter):
 
-    def __init__(self, pattern: Pattern, tempo_bpm=120):
+    def __init__(self, pattern: Pattern, tempo_bpm=120, events_cache: dict = None, transpose: int = 0,
+                 seed: Union[int, random.Random] = None, disk_cache: DiskCache = None):
+        """
+        :param pattern: pattern to export
+        :param tempo_bpm: tempo to write to midi file
+        :param events_cache: dict to cache encoded midi events of patterns in, can be shared
+        between exporters (e.g. song and its patterns) to render every pattern only once
+        :param transpose: number of semitones to transpose all the notes by
+        :param seed: seed of random arps (or random.Random to draw a seed from), see arps.make_seed().
+        Exports with the same seed have the same random arps
+        :param disk_cache: on-disk cache of rendered patterns, shared between runs
+        """
 
         self.pattern = pattern
+        self.transpose = transpose
+        self.seed = arps.make_seed(seed)
+        self.disk_cache = disk_cache
         # patterns themselves do not store tempo information
         # as it is set globally for the whole song, so we just
         # go with whatever is passed to us
         self.tempo_bpm = tempo_bpm
 
+        # encoded midi events of patterns, see get_pattern_track_fragments()
+        self._pattern_track_fragments = events_cache if events_cache is not None else {}
+
+    def get_tempo_bpm(self) -> float:
+        return self.tempo_bpm
+
     def get_list_of_instruments(self):
         # todo: for songs get instrument names from instrument files (or filenames)
-        instruments = set()
-
-        for track in self.pattern.tracks:
-            for step in track.steps:
-                if step.instrument_number is not None:  # can be zero
-                    instruments.add(step.instrument_number)
+        # only instruments that actually play notes are listed
+        return self.pattern.get_summary().instruments
 
-        return sorted(instruments)
+    def iter_slots(self, ticks_per_step: int) -> Iterator[Tuple[Pattern, int, int, int]]:
+        yield self.pattern, 0, 0, self.pattern.tracks[0].length * ticks_per_step
 
     @staticmethod
     def get_midi_note_value(note: Note):
@@ -57,11 +413,11 @@ class PatternToMidiExporter(BaseMidiExporter):
 
         # midi middle C (C4) is 60
         # tracker C4 is 48
-        return note.value+12
+        return note.value + Note.MIDI_NOTE_OFFSET
 
-    def generate_midi(self, midi_file: MIDIFile = None,
+    def generate_midi(self, midi_file: StandardMidiFile = None,
                       instrument_to_midi_track_map: dict = None,
-                      start_time_offset: float = 0) -> MIDIFile:
+                      start_time_offset: float = 0) -> StandardMidiFile:
 
         degrees = [60, 62, 64, 65, 67, 69, 71, 72]  # MIDI note number
 
@@ -94,7 +450,6 @@ class PatternToMidiExporter(BaseMidiExporter):
             instruments = instrument_to_midi_track_map.keys()
 
         channel = 0
-        default_volume = 127  # 0-127, as per the MIDI standard
 
         if not midi_file:
             # if we are not supplied with a midi file,
@@ -108,7 +463,7 @@ class PatternToMidiExporter(BaseMidiExporter):
             tempo = 60  # In BPM
 
             midi_tracks_count = len(instruments)
-            midi_file = MIDIFile(midi_tracks_count)
+            midi_file = StandardMidiFile(midi_tracks_count)
             midi_file.addTempo(track=0, time=0, tempo=self.tempo_bpm)
 
             for i in range(len(instruments)):
@@ -116,146 +471,227 @@ class PatternToMidiExporter(BaseMidiExporter):
                 # todo: instrument 48 is midi instrument 1 the next 15 are also midi instruments - set their names
                 midi_file.addTrackName(track=i, time=0, trackName=f"Instrument {instruments[i]}")
 
-        for track in self.pattern.tracks:
-
-            for step_number in range(track.length):
-
-                step = track.steps[step_number]
-
-                if step.note.is_empty():
-                    continue
-
-                if step.note.is_off_fad_or_cut():
-                    # adding note off event is complicated, it's easier to rely on duration
-                    # argument for addNote
-                    continue
-
-                else:
-
-                    # we've got a note
-                    # check when the next note or NOTE OFF appears on this track
-                    # so we can calculate note duration
-                    note_end_position = None
-
-                    # iterate the track from the next step till the end
-                    # until we encounter a note
-                    for inner_step_number in range(step_number+1, track.length):
-                        inner_step = track.steps[inner_step_number]
-                        if inner_step.note.is_off_fad_or_cut():
-                            # found note break
-                            note_end_position = inner_step_number
-                            break
-                        if not inner_step.note.is_empty():
-                            # found next note - time to disable this one
-                            note_end_position = inner_step_number
-                            break
-
-                    # if we haven't found anything, we'll just disable the note at
-                    # the end of the pattern
-                    if not note_end_position:
-                        # make sure we disable the note after pattern ends and not at
-                        # the last step of the pattern
-                        note_end_position = track.length
-
-                    duration = (note_end_position - step_number) * PatternToMidiExporter.MIDI_16TH_NOTE_TIME_VALUE
-
-                    # add actual notes to midi file data
-                    if step.get_arp():
-                        # arpeggio
-                        arp = step.get_arp()
-
-                        notes_iterator = arp.get_notes_iterator()
-
-                        # time at which each consequent note in arp starts playing
-                        arp_note_start_time = step_number * PatternToMidiExporter.MIDI_16TH_NOTE_TIME_VALUE
-                        # time at which we should stop arpeggiating
-                        arp_end_time = note_end_position * PatternToMidiExporter.MIDI_16TH_NOTE_TIME_VALUE
-                        # duration of each note in arpeggio
-                        arp_note_duration = arp.division * PatternToMidiExporter.MIDI_16TH_NOTE_TIME_VALUE
-
-                        for note in notes_iterator:
-                            # every note has a length of arp division
-                            # (arp division is basically number of 1/16steps each note is played,
-                            # can be fractional)
-                            # so we have to add notes playing after each other and stop ath the NOTE OFF/CUT/FAD
-                            # event
-                            # todo: also stop if step with arp value 0 is encountered (that's how tracker does it)
-                            #  note that this step will not return arp as we check for value in get_arp,
-                            #  so we'll probably need another method like has_arp_stop_event or something
-                            #  that specifically check for arp effect with 0 value
-
-
-                            # fixme: should it be just > instead of >=?
-                            if arp_note_start_time >= arp_end_time:
-                                # reached next note, CUT/FAD/OFF event
-                                # or end of pattern (actually end of the patter probably should not
-                                # end arp if there is a next pattern in song mode, but should do it if
-                                # we are rendering just one pattern, since we have to end sending notes
-                                # to midi file somewhere
-                                break
-
-                            # check that the  the note we are about to end won't end playing after
-                            # intended place for the arp to stop (this usually happens with
-                            # uneven divisions like 6, 1/3, etc.)
-                            if arp_note_start_time + arp_note_duration >= arp_end_time:
-                                # this is the last note in this arp
-                                # and it's too long (going beyond note OFF/CUT/FAD or pattern end),
-                                # so we going to jsut shorten its duration
-                                arp_note_duration = arp_end_time - arp_note_start_time
-
-                            midi_file.addNote(track=instrument_to_midi_track_map[step.instrument_number],
-                                              channel=channel,
-                                              pitch=PatternToMidiExporter.get_midi_note_value(note),
-                                              time=start_time_offset + arp_note_start_time,
-                                              duration=arp_note_duration,
-                                              # TODO: write velocity fx value if set (needs to be converted to 0...127!!!)
-                                              volume=default_volume,
-                                              )
-
-                            # increment starting time for the next note
-                            arp_note_start_time += arp_note_duration
-
-
-                    elif step.get_chord():
-                        # chord
-                        chord = step.get_chord()
-                        for note in chord.notes:
-                            # TODO: make this DRY as this differs from default case with one note just by one argument
-                            midi_file.addNote(track=instrument_to_midi_track_map[step.instrument_number],
-                                              channel=channel,
-                                              pitch=PatternToMidiExporter.get_midi_note_value(note),
-                                              time=start_time_offset + step_number * PatternToMidiExporter.MIDI_16TH_NOTE_TIME_VALUE,
-                                              duration=duration,
-                                              # TODO: write velocity fx value if set (needs to be converted to 0...127!!!)
-                                              volume=default_volume,
-                                              )
-
-                    else:
-                        # note that there is a bug in MIDIUtil
-                        # that sometimes crashes when a note played by the same
-                        # instrument is overlapping with itself
-                        # https://github.com/MarkCWirt/MIDIUtil/issues/34
-                        # there is also a bug with track numbers/note values overlapping
-                        # that is also described in the same deInterlaveNotes method in MIDIUtil
-
-
-                        # default case - just a regular single note playing
-                        midi_file.addNote(track=instrument_to_midi_track_map[step.instrument_number],
-                                          channel=channel,
-                                          pitch=PatternToMidiExporter.get_midi_note_value(step.note),
-                                          time=start_time_offset + step_number*PatternToMidiExporter.MIDI_16TH_NOTE_TIME_VALUE,
-                                          duration=duration,
-                                          # TODO: write velocity fx value if set (needs to be converted to 0...127!!!)
-                                          volume=default_volume,
-                                          )
+        # notes are compiled once per pattern in ticks, so offset is converted
+        # to ticks once (pattern lengths are whole steps, so it's always exact)
+        start_tick_offset = midi_file.time_to_ticks(start_time_offset)
+        ticks_per_step = int(midi_file.ticks_per_quarter_note * PatternToMidiExporter.MIDI_16TH_NOTE_TIME_VALUE)
+
+        for instrument_number, notes in self.get_pattern_instrument_notes(self.pattern, ticks_per_step).items():
+            for pitch, start_tick, end_tick, velocity in notes:
+                midi_file.add_note_ticks(track=instrument_to_midi_track_map[instrument_number],
+                                         channel=channel,
+                                         pitch=pitch,
+                                         start_tick=start_tick_offset + start_tick,
+                                         duration_ticks=end_tick - start_tick,
+                                         volume=velocity,
+                                         )
+
+        for instrument_number, controls in self.get_pattern_instrument_controls(self.pattern, ticks_per_step).items():
+            for tick, controller, value in controls:
+                midi_file.add_control_change_ticks(track=instrument_to_midi_track_map[instrument_number],
+                                                   channel=channel,
+                                                   tick=start_tick_offset + tick,
+                                                   controller=controller,
+                                                   value=value)
 
         return midi_file
 
 
+def render_song_segment(patterns: List[Pattern], slots: List[Tuple[int, int, int, int]], ticks_per_step: int,
+                        transpose: int = 0, optimize: bool = True,
+                        seed: int = arps.DEFAULT_SEED,
+                        disk_cache: DiskCache = None
+                        ) -> Tuple[Dict[int, List[Tuple[int, EncodedFragment]]], Dict[int, Dict[int, EncodedFragment]]]:
+    """
+    Renders midi events of a segment of song slots. Runs in worker processes,
+    see SongToMidiExporter.render_segments()
+    :param patterns: unique patterns played in the segment
+    :param slots: (index of the pattern in patterns, pattern start time in ticks,
+    start tick, end tick) tuples, see BaseMidiExporter.iter_slots()
+    :return: (segment fragments, pattern fragments) tuple. Segment fragments are
+    instrument number: list of (slot start time in ticks, encoded fragment) tuples ordered by time.
+    Pattern fragments are index of the pattern in patterns: fragments of the whole pattern
+    (see BaseMidiExporter.get_pattern_track_fragments()) for patterns that are played whole,
+    so the main process does not render them again
+    """
+    # patterns that are played multiple times in the segment are rendered once
+    events_cache = {}
+    exporters = {}
+    segment_fragments = {}
+    for pattern_index, start_tick_offset, from_tick, to_tick in slots:
+        pattern = patterns[pattern_index]
+        exporter = exporters.get(pattern_index)
+        if exporter is None:
+            exporter = exporters[pattern_index] = PatternToMidiExporter(
+                pattern=pattern, events_cache=events_cache, transpose=transpose, seed=seed, disk_cache=disk_cache)
+            exporter.optimize = optimize
+        for instrument_number, fragment in exporter.get_pattern_track_fragments(pattern, ticks_per_step,
+                                                                                from_tick, to_tick).items():
+            segment_fragments.setdefault(instrument_number, []).append((start_tick_offset, fragment))
+
+    pattern_fragments = {}
+    for pattern_index, exporter in exporters.items():
+        fragments = events_cache.get(exporter.get_fragments_cache_key(patterns[pattern_index], ticks_per_step))
+        if fragments is not None:
+            pattern_fragments[pattern_index] = fragments
+
+    return segment_fragments, pattern_fragments
+
+
 class SongToMidiExporter(BaseMidiExporter):
 
-    def __init__(self, song: Song):
+    def __init__(self, song: Song, start_step: int = 0, end_step: int = None, events_cache: dict = None,
+                 tempo_bpm: float = None, transpose: int = 0, repeat: int = 1, workers: int = 1,
+                 seed: Union[int, random.Random] = None, disk_cache: DiskCache = None):
+        """
+        :param song: song to export
+        :param start_step: zero-based song step to start export from (to export just a part of the song)
+        :param end_step: zero-based song step to end export at (not included), end of the song by default.
+        Exported part of the song starts at the beginning of midi file.
+        See Song.get_song_step() and Song.get_song_step_at_time() to get steps of slots and times.
+        :param events_cache: dict to cache encoded midi events of patterns in, can be shared
+        between exporters (e.g. song and its patterns) to render every pattern only once
+        :param tempo_bpm: tempo to write to midi file, song tempo by default
+        :param transpose: number of semitones to transpose all the notes by
+        :param repeat: number of times to repeat the song (or its exported part) in midi file
+        :param workers: number of processes to render song on. Song is split into contiguous
+        segments that are rendered in parallel, written midi is the same as rendered on one process
+        :param seed: seed of random arps (or random.Random to draw a seed from), see arps.make_seed().
+        Exports with the same seed have the same random arps
+        :param disk_cache: on-disk cache of rendered patterns, shared between runs
+        (and worker processes), so only patterns that changed are rendered
+        """
         self.song = song
+        self.start_step = start_step
+        self.end_step = end_step
+        self.tempo_bpm = tempo_bpm
+        self.transpose = transpose
+        self.seed = arps.make_seed(seed)
+        self.disk_cache = disk_cache
+
+        if repeat < 1:
+            raise ValueError(f"Song should be repeated at least once, got {repeat}")
+        self.repeat = repeat
+
+        if workers < 1:
+            raise ValueError(f"Song should be rendered on at least one process, got {workers}")
+        self.workers = workers
+
+        # encoded midi events of patterns, see get_pattern_track_fragments()
+        self._pattern_track_fragments = events_cache if events_cache is not None else {}
+
+    def get_tempo_bpm(self) -> float:
+        if self.tempo_bpm is not None:
+            return self.tempo_bpm
+        return self.song.bpm
+
+    def get_steps_range(self) -> Tuple[int, int]:
+        """:return: (start step, end step) of the exported part of the song"""
+        song_length = self.song.get_length_in_steps()
+        start_step = max(0, self.start_step)
+        end_step = song_length if self.end_step is None else min(self.end_step, song_length)
+        return start_step, max(start_step, end_step)
+
+    def get_slots_range(self) -> range:
+        """:return: zero-based numbers of slots that are (at least partially) exported"""
+        start_step, end_step = self.get_steps_range()
+        if start_step == end_step:
+            return range(0)
+        return range(self.song.get_slot_at_step(start_step)[0],
+                      self.song.get_slot_at_step(end_step - 1)[0] + 1)
+
+    def iter_slots(self, ticks_per_step: int) -> Iterator[Tuple[Pattern, int, int, int]]:
+        start_step, end_step = self.get_steps_range()
+        slot_start_steps = self.song.get_slot_start_steps()
+        slots_range = self.get_slots_range()
+
+        for repetition in range(self.repeat):
+            # every repetition starts right after the previous one
+            repetition_start_step = start_step - repetition * (end_step - start_step)
+
+            # only slots within exported range are processed,
+            # the range itself is found with bisect over slot start steps
+            for slot in slots_range:
+                pattern = self.song.pattern_mapping[self.song.pattern_chain[slot]]
+                slot_start_step = slot_start_steps[slot]
+                # every next pattern starts after the previous pattern ended,
+                # exported part of the song starts at the beginning of midi file
+                yield (pattern,
+                       (slot_start_step - repetition_start_step) * ticks_per_step,
+                       (max(start_step, slot_start_step) - slot_start_step) * ticks_per_step,
+                       (min(end_step, slot_start_steps[slot + 1]) - slot_start_step) * ticks_per_step)
+
+    def get_segments(self, ticks_per_step: int, segments_count: int) -> List[List[Tuple[Pattern, int, int, int]]]:
+        """
+        Splits exported slots into contiguous segments with about
+        the same number of midi events to render in each of them
+        :return: lists of slots, see iter_slots()
+        """
+        slots = list(self.iter_slots(ticks_per_step))
+
+        # every slot costs at least something, even if it has no notes
+        weights = [slot[0].get_summary().estimated_midi_event_count + 1 for slot in slots]
+        segment_weight = sum(weights) / segments_count
+
+        segments = [[]]
+        weight = 0
+        for slot, slot_weight in zip(slots, weights):
+            if weight >= segment_weight * len(segments) and len(segments) < segments_count:
+                segments.append([])
+            segments[-1].append(slot)
+            weight += slot_weight
+
+        return segments
+
+    def render_segments(self, ticks_per_step: int) -> List[Dict[int, List[Tuple[int, EncodedFragment]]]]:
+        """
+        Renders song segments on a pool of self.workers processes. Whole patterns
+        rendered by worker processes are added to events cache, so exporters
+        that share it (e.g. of project patterns) do not render them again
+        :return: rendered segments in the order they are played, see render_song_segment()
+        """
+        jobs = []
+        for segment in self.get_segments(ticks_per_step, self.workers):
+            # only unique patterns of the segment are sent to a worker process
+            patterns = []
+            pattern_indexes = {}
+            slots = []
+            for pattern, start_tick_offset, from_tick, to_tick in segment:
+                pattern_index = pattern_indexes.get(id(pattern))
+                if pattern_index is None:
+                    pattern_index = pattern_indexes[id(pattern)] = len(patterns)
+                    patterns.append(pattern)
+                slots.append((pattern_index, start_tick_offset, from_tick, to_tick))
+            jobs.append((patterns, slots))
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(render_song_segment, patterns, slots, ticks_per_step,
+                                       self.transpose, self.optimize, self.seed, self.disk_cache)
+                       for patterns, slots in jobs]
+
+            segments = []
+            for (patterns, slots), future in zip(jobs, futures):
+                segment_fragments, pattern_fragments = future.result()
+                segments.append(segment_fragments)
+                for pattern_index, fragments in pattern_fragments.items():
+                    self._pattern_track_fragments.setdefault(
+                        self.get_fragments_cache_key(patterns[pattern_index], ticks_per_step), fragments)
+            return segments
+
+    def get_midi_tracks(self, ticks_per_quarter_note: int = TICKS_PER_QUARTER_NOTE) -> List[Iterable[Tuple[int, bytes]]]:
+        if self.workers == 1:
+            return super().get_midi_tracks(ticks_per_quarter_note)
+
+        ticks_per_step = int(ticks_per_quarter_note * BaseMidiExporter.MIDI_16TH_NOTE_TIME_VALUE)
+        segments = self.render_segments(ticks_per_step)
+
+        tracks = [iter([(0, tempo_message(self.get_tempo_bpm()))])]
+        for instrument_number in self.get_list_of_instruments():
+            # event streams of segments are merged in time order
+            fragments = heapq.merge(*[segment.get(instrument_number, ()) for segment in segments],
+                                    key=lambda event: event[0])
+            tracks.append(self.iter_track_events(instrument_number, ticks_per_quarter_note, fragments=fragments))
+        return tracks
 
     def get_list_of_instruments(self):
         """
@@ -264,14 +700,14 @@ class SongToMidiExporter(BaseMidiExporter):
         Used to create midi file with  proper instrument tracks.
         :return:
         """
-        instruments = set()
-        # iterate over unique patterns only
-        for pattern in self.song.pattern_mapping.values():
-            instruments.update(PatternToMidiExporter(pattern=pattern).get_list_of_instruments())
+        instruments_mask = 0
+        # iterate over unique patterns that are played in the exported part of the song only
+        for pattern_number in sorted(set(self.song.pattern_chain[slot] for slot in self.get_slots_range())):
+            instruments_mask |= self.song.pattern_mapping[pattern_number].get_summary().instruments_mask
 
-        return sorted(instruments)
+        return PatternSummary(instruments_mask=instruments_mask).instruments
 
-    def generate_midi(self) -> MIDIFile:
+    def generate_midi(self) -> StandardMidiFile:
         # raise NotImplementedError()
 
         # tracker tracks are not actual tracks, but voices,
@@ -287,9 +723,9 @@ class SongToMidiExporter(BaseMidiExporter):
         # this should be faster than calling instruments.indexOf()
         instrument_to_midi_track_map = {}
 
-        midi_file = MIDIFile(midi_tracks_count)
+        midi_file = StandardMidiFile(midi_tracks_count)
         #FIXME: write bpm to song to get it from there
-        midi_file.addTempo(track=0, time=0, tempo=self.song.bpm)
+        midi_file.addTempo(track=0, time=0, tempo=self.get_tempo_bpm())
 
         for i in range(len(instruments)):
             # todo: get actual track names from project file (or are they stored in instrument files?)
@@ -301,28 +737,193 @@ class SongToMidiExporter(BaseMidiExporter):
         print(f"instruments: {instruments}")
         print(f"instrument_to_midi_track_map: {instrument_to_midi_track_map}")
 
-        previous_pattern: Optional[Pattern] = None
+        ticks_per_step = int(midi_file.ticks_per_quarter_note * SongToMidiExporter.MIDI_16TH_NOTE_TIME_VALUE)
 
+        # notes of every unique pattern are compiled only once, they are
+        # then placed at every song slot where this pattern is played
         j = 0
-        start_time_offset = 0
         print(self.song.pattern_chain)
-        for pattern in self.song.get_song_as_patterns():    #fixme: temporary slice for debug
+        for pattern, start_tick_offset, from_tick, to_tick in self.iter_slots(ticks_per_step):
             j+=1
             print(f"Rendering song slot {j}")
-            exporter = PatternToMidiExporter(pattern=pattern)
 
-            if previous_pattern:
-                # every next pattern should write midi data
-                # after the previous pattern ended,
-                # so we have to add time offset for every pattern
-                start_time_offset += previous_pattern.tracks[0].length * SongToMidiExporter.MIDI_16TH_NOTE_TIME_VALUE
+            for instrument_number, notes in self.get_pattern_instrument_notes(pattern, ticks_per_step,
+                                                                              from_tick, to_tick).items():
+                for pitch, start_tick, end_tick, velocity in notes:
+                    midi_file.add_note_ticks(track=instrument_to_midi_track_map[instrument_number],
+                                             channel=SongToMidiExporter.MIDI_CHANNEL,
+                                             pitch=pitch,
+                                             start_tick=start_tick_offset + start_tick,
+                                             duration_ticks=end_tick - start_tick,
+                                             volume=velocity,
+                                             )
+
+            for instrument_number, controls in self.get_pattern_instrument_controls(pattern, ticks_per_step,
+                                                                                    from_tick, to_tick).items():
+                for tick, controller, value in controls:
+                    midi_file.add_control_change_ticks(track=instrument_to_midi_track_map[instrument_number],
+                                                       channel=SongToMidiExporter.MIDI_CHANNEL,
+                                                       tick=start_tick_offset + tick,
+                                                       controller=controller,
+                                                       value=value)
 
-            # todo: add arguments and handle them
-            # todo: no need to do value declaration here really, we already pass it by reference
-            midi_file = exporter.generate_midi(midi_file=midi_file,
-                                               instrument_to_midi_track_map=instrument_to_midi_track_map,
-                                                start_time_offset=start_time_offset)
+        return midi_file
 
-            previous_pattern = pattern
 
-        return midi_file
+class ExportVariant:
+    """
+    Describes a variant of exported song midi file
+    """
+
+    def __init__(self, transpose: int = 0, tempo_bpm: float = None, repeat: int = 1, name: str = None):
+        """
+        :param transpose: number of semitones to transpose all the notes by
+        :param tempo_bpm: tempo to write to midi file, song tempo by default
+        :param repeat: number of times to repeat the song
+        :param name: name of the variant, used in file names. Generated from parameters by default
+        """
+        self.transpose = transpose
+        self.tempo_bpm = tempo_bpm
+        self.repeat = repeat
+        self.name = name
+
+    def get_name(self) -> str:
+        if self.name:
+            return self.name
+
+        parts = []
+        if self.transpose:
+            parts.append(f"transpose{self.transpose:+d}")
+        if self.tempo_bpm is not None:
+            parts.append(f"{self.tempo_bpm:g}bpm")
+        if self.repeat != 1:
+            parts.append(f"x{self.repeat}")
+        return "_".join(parts) or "original"
+
+    def __str__(self):
+        return self.get_name()
+
+
+class SongVariantsExporter:
+    """
+    Exports multiple variants of the same song (transposed, with other tempo,
+    repeated) from a single parsed project. Every pattern is decoded and compiled
+    only once for all the variants. Variants with the same transposition share
+    rendered midi events too, tempo and repetitions are applied
+    when events are written.
+    """
+
+    def __init__(self, project: Project, variants: List[ExportVariant], seed: Union[int, random.Random] = None,
+                 disk_cache: DiskCache = None):
+        """
+        :param project: project to export song of
+        :param variants: variants to export
+        :param seed: seed of random arps, the same for all the variants
+        :param disk_cache: on-disk cache of rendered patterns, shared between runs
+        """
+        self.project = project
+        self.variants = variants
+        self.seed = arps.make_seed(seed)
+        self.disk_cache = disk_cache
+
+        # encoded midi events of patterns shared by all the variants
+        self.events_cache = {}
+
+    def get_exporter(self, variant: ExportVariant) -> SongToMidiExporter:
+        return SongToMidiExporter(song=self.project.song, events_cache=self.events_cache,
+                                  tempo_bpm=variant.tempo_bpm, transpose=variant.transpose,
+                                  repeat=variant.repeat, seed=self.seed, disk_cache=self.disk_cache)
+
+    def iter_exporters(self) -> Iterator[Tuple[ExportVariant, SongToMidiExporter]]:
+        for variant in self.variants:
+            yield variant, self.get_exporter(variant)
+
+    def write_midi_files(self, output_filename: str) -> List[str]:
+        """
+        Writes every variant to a separate file, variant name is added
+        to the output file name, e.g. song.mid -> song_transpose+2.mid
+        :return: names of written files in the order of variants
+        """
+        base_filename, extension = os.path.splitext(output_filename)
+
+        filenames = []
+        for variant, exporter in self.iter_exporters():
+            filename = f"{base_filename}_{variant.get_name()}{extension or '.mid'}"
+            exporter.write_midi_file(filename)
+            filenames.append(filename)
+        return filenames
+
+
+def get_patterns_folder(output_filename: str) -> str:
+    """:return: folder patterns of a project are exported to, see export_project()"""
+    return os.path.join(os.path.dirname(output_filename), PATTERNS_MIDI_FOLDER_NAME)
+
+
+def export_project(song: Song, output_filename: str, export_patterns: bool = True, workers: int = 1,
+                   seed: Union[int, random.Random] = None,
+                   disk_cache: DiskCache = None) -> Iterator[Tuple[Optional[int], Optional[Pattern], str]]:
+    """
+    Exports song and all of the project patterns to separate midi files.
+    Every unique pattern is rendered only once: song and pattern exporters
+    share rendered midi events. Files are written on a thread pool.
+    Files are exported as the returned iterator is consumed, so it should be consumed till the end.
+    :param song: project song
+    :param output_filename: song midi file name, patterns are exported
+    to patterns_midi folder next to it (see get_patterns_folder())
+    :param export_patterns: also export every pattern of the project to a separate midi file
+    :param workers: number of processes to render song on
+    :param seed: seed of random arps, see arps.make_seed()
+    :param disk_cache: on-disk cache of rendered patterns
+    :return: (pattern number, pattern, midi file name) tuples of written files in the order
+    they are written. Pattern number and pattern are None for the song midi file
+    """
+    output_folder = os.path.dirname(output_filename)
+    if output_folder:
+        os.makedirs(output_folder, exist_ok=True)
+
+    # midi events of every pattern, shared by all the exporters
+    events_cache = {}
+
+    song_exporter = SongToMidiExporter(song=song, events_cache=events_cache, workers=workers, seed=seed,
+                                       disk_cache=disk_cache)
+
+    pattern_exporters = []
+    if export_patterns:
+        # create directory for patterns
+        # in the same folder we export project to
+        patterns_folder = get_patterns_folder(output_filename)
+        os.makedirs(patterns_folder, exist_ok=True)
+
+        for number, pattern in song.pattern_mapping.items():
+            pattern_exporter = PatternToMidiExporter(pattern=pattern, tempo_bpm=int(song.bpm),
+                                                     events_cache=events_cache, seed=seed, disk_cache=disk_cache)
+            pattern_output_filename = os.path.join(patterns_folder, f"pattern_{number:02}.mid")
+            pattern_exporters.append((number, pattern, pattern_exporter, pattern_output_filename))
+
+    # patterns are rendered here, in the calling thread, so threads
+    # only encode and write files (random arps don't depend on the order
+    # patterns are rendered in, see arps.get_step_random())
+    if workers > 1:
+        # song is rendered on worker processes, they are started
+        # before any threads so that they are not forked from a multithreaded process
+        song_exporter.write_midi_file(output_filename)
+        yield None, None, output_filename
+    else:
+        song_exporter.prerender()
+    for number, pattern, pattern_exporter, pattern_output_filename in pattern_exporters:
+        pattern_exporter.prerender()
+
+    with ThreadPoolExecutor() as executor:
+        if workers == 1:
+            song_future = executor.submit(song_exporter.write_midi_file, output_filename)
+        pattern_futures = [executor.submit(pattern_exporter.write_midi_file, pattern_output_filename)
+                           for number, pattern, pattern_exporter, pattern_output_filename in pattern_exporters]
+
+        if workers == 1:
+            song_future.result()
+            yield None, None, output_filename
+
+        for (number, pattern, pattern_exporter, pattern_output_filename), future \
+                in zip(pattern_exporters, pattern_futures):
+            future.result()
+            yield number, pattern, pattern_output_filename
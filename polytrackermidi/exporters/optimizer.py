@@ -0,0 +1,79 @@
+# Cleans up notes and automation of a midi track before they are encoded
+
+__author__ = "Alexey 'DataGreed' Strelkov"
+
+from typing import Iterable, List, Tuple
+
+# notes shorter than this are dropped
+MIN_NOTE_DURATION_TICKS = 1
+
+
+def optimize_notes(notes: Iterable[Tuple[int, int, int, int]],
+                   min_duration_ticks: int = MIN_NOTE_DURATION_TICKS) -> List[Tuple[int, int, int, int]]:
+    """
+    Cleans up notes of one midi track (instrument) in a single pass over sorted notes:
+    - notes shorter than min_duration_ticks are dropped (e.g. arp tails cut at the arp end);
+    - notes of the same pitch that start at the same time (e.g. the same note
+      played by chords on different tracks) are merged into one, the longest and loudest;
+    - a note that is retriggered by the next note of the same pitch
+      while still playing is cut where the next note starts.
+    So no two notes of the same pitch overlap and every note on event
+    has exactly one note off event, which also makes files smaller.
+    :param notes: (midi pitch, start tick, end tick, velocity) tuples in any order
+    :return: (midi pitch, start tick, end tick, velocity) tuples sorted by pitch and start tick
+    """
+    result = []
+    previous = None
+
+    for note in sorted(notes):
+        pitch, start_tick, end_tick, velocity = note
+
+        if end_tick - start_tick < min_duration_ticks:
+            continue
+
+        if previous is not None and previous[0] == pitch and start_tick < previous[2]:
+            # overlaps with the previous note of the same pitch
+            if start_tick == previous[1]:
+                # both start at the same time - merge them
+                previous = (pitch, start_tick, max(end_tick, previous[2]), max(velocity, previous[3]))
+                continue
+
+            # retrigger - previous note stops where this one starts
+            previous = (pitch, previous[1], start_tick, previous[3])
+
+        if previous is not None:
+            result.append(previous)
+        previous = note
+
+    if previous is not None:
+        result.append(previous)
+
+    return result
+
+
+def optimize_controls(controls: Iterable[Tuple[int, int, int]],
+                      initial_values: dict = None) -> List[Tuple[int, int, int]]:
+    """
+    Run-length compresses automation of one midi track (instrument),
+    so steps where controller value doesn't change emit no events:
+    - if a controller is set multiple times at the same tick
+      (e.g. by different tracks), only the last value is kept;
+    - values that are the same as the current value of the controller are dropped.
+    :param controls: (tick, controller, value) tuples in the order they are set
+    :param initial_values: controller: value dict of values controllers already have
+    :return: (tick, controller, value) tuples sorted by tick
+    """
+    # the last value at every tick, sort is stable so the order of values set at the same tick is kept
+    last_at_tick = {}
+    for tick, controller, value in sorted(controls, key=lambda control: control[0]):
+        last_at_tick[(tick, controller)] = value
+
+    current_values = dict(initial_values) if initial_values else {}
+    result = []
+    for (tick, controller), value in last_at_tick.items():
+        if current_values.get(controller) == value:
+            continue
+        current_values[controller] = value
+        result.append((tick, controller, value))
+
+    return result
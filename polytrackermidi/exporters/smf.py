@@ -0,0 +1,397 @@
+# Standard MIDI File (*.mid) writer
+
+__author__ = "Alexey 'DataGreed' Strelkov"
+
+import os
+import shutil
+import struct
+import tempfile
+from typing import BinaryIO, Iterable, List, Sequence, Tuple, Union
+
+try:
+    # fcntl is not available on windows, append mode is only detected by file mode there
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# MIDIUtil's default, so files look the same as before
+TICKS_PER_QUARTER_NOTE = 960
+
+# encoded track data is written to output in parts of this many events (or fragments)
+STREAM_PART_LENGTH = 1024
+
+# buffer size used to copy spooled tracks to output
+STREAM_BUFFER_SIZE = 64 * 1024
+
+# order of events that happen at the same tick:
+# meta events go first and a note that ends at the same tick
+# another note starts is released before the next one is played.
+# Controllers are set right before notes start, so they affect them
+ORDER_META = 0
+ORDER_NOTE_OFF = 1
+ORDER_CONTROL = 2
+ORDER_NOTE_ON = 3
+
+END_OF_TRACK_MESSAGE = b"\xff\x2f\x00"
+
+# data bytes of channel messages (pitches, velocities, controller values) are 7 bit
+MAX_DATA_BYTE = 0x7F
+
+
+def encode_variable_length(value: int) -> bytes:
+    """
+    Encodes an integer as a variable length quantity:
+    7 bits per byte, most significant bits first,
+    all bytes except the last one have bit 7 set
+    """
+    if value < 0x80:
+        # the most common case - short delta time
+        return bytes((value,))
+
+    result = [value & 0x7F]
+    value >>= 7
+    while value:
+        result.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(result))
+
+
+def check_data_byte(name: str, value: int):
+    """
+    Data bytes of channel messages are 7 bit, bigger values would be read
+    as status bytes and break the rest of the track
+    :raises ValueError: if value is out of 0..127 range
+    """
+    if not 0 <= value <= MAX_DATA_BYTE:
+        raise ValueError(f"Midi {name} should be in 0..{MAX_DATA_BYTE} range, got {value}")
+
+
+def note_on_message(channel: int, pitch: int, velocity: int) -> bytes:
+    check_data_byte("pitch", pitch)
+    check_data_byte("velocity", velocity)
+    return bytes((0x90 | channel, pitch, velocity))
+
+
+def note_off_message(channel: int, pitch: int) -> bytes:
+    # note on with zero velocity works as note off and has the same
+    # status byte as note on, so it can be written with running status
+    check_data_byte("pitch", pitch)
+    return bytes((0x90 | channel, pitch, 0))
+
+
+def control_change_message(channel: int, controller: int, value: int) -> bytes:
+    check_data_byte("controller", controller)
+    check_data_byte("controller value", value)
+    return bytes((0xB0 | channel, controller, value))
+
+
+def tempo_message(tempo_bpm: float) -> bytes:
+    # tempo is stored as microseconds per quarter note
+    microseconds = int(60000000 / tempo_bpm)
+    return b"\xff\x51\x03" + microseconds.to_bytes(3, "big")
+
+
+def track_name_message(name: str) -> bytes:
+    data = name.encode("ISO-8859-1")
+    return b"\xff\x03" + encode_variable_length(len(data)) + data
+
+
+class EncodedFragment:
+    """
+    Part of a track (e.g. notes of one instrument in a pattern) encoded once,
+    that can be placed at any time of any track. Only delta time and status byte
+    of the first event depend on the events before the fragment, so they are kept
+    separately and everything else is stored encoded.
+    """
+
+    __slots__ = ("first_tick", "first_message", "data", "last_tick", "last_status")
+
+    # first tick, last tick, last status, first message length, data length, see to_bytes()
+    HEADER = struct.Struct("<IIBBI")
+
+    def __init__(self, events: Sequence[Tuple[int, bytes]]):
+        """
+        :param events: (time in ticks relative to the fragment start, channel message) tuples
+        ordered by time, there must be at least one event
+        """
+        self.first_tick, self.first_message = events[0]
+
+        encoder = TrackEncoder()
+        encoder.previous_tick = self.first_tick
+        encoder.running_status = self.first_message[0]
+        self.data = encoder.encode(events[1:])
+
+        self.last_tick = encoder.previous_tick
+        self.last_status = encoder.running_status
+
+    def to_bytes(self) -> bytes:
+        """
+        :return: fragment as plain bytes: header followed by the first message and encoded data
+        (e.g. to store it in a file), see from_bytes()
+        """
+        return EncodedFragment.HEADER.pack(self.first_tick, self.last_tick, self.last_status,
+                                           len(self.first_message), len(self.data)) + self.first_message + self.data
+
+    @staticmethod
+    def from_bytes(buffer: bytes, offset: int = 0) -> Tuple["EncodedFragment", int]:
+        """
+        Reads fragment written by to_bytes()
+        :param buffer: bytes to read fragment from
+        :param offset: position of the fragment in buffer
+        :return: (fragment, position right after the fragment in buffer) tuple
+        :raises ValueError: if buffer does not contain a whole fragment
+        """
+        try:
+            first_tick, last_tick, last_status, first_message_length, data_length = \
+                EncodedFragment.HEADER.unpack_from(buffer, offset)
+        except struct.error as e:
+            raise ValueError(f"Broken encoded fragment: {e}")
+
+        offset += EncodedFragment.HEADER.size
+        end = offset + first_message_length + data_length
+        if not first_message_length or end > len(buffer):
+            raise ValueError(f"Broken encoded fragment: expected {end} bytes, got {len(buffer)}")
+
+        # fragment is restored as is, without encoding events again
+        fragment = EncodedFragment.__new__(EncodedFragment)
+        fragment.first_tick = first_tick
+        fragment.first_message = bytes(buffer[offset:offset + first_message_length])
+        fragment.data = bytes(buffer[offset + first_message_length:end])
+        fragment.last_tick = last_tick
+        fragment.last_status = last_status
+        return fragment, end
+
+
+class TrackEncoder:
+    """
+    Encodes track events to MTrk chunk data incrementally,
+    so a track can be encoded in parts without keeping all of its events in memory.
+    Keeps time of the previous event and running status between parts.
+    """
+
+    def __init__(self):
+        self.previous_tick = 0
+        self.running_status = None
+
+    def encode(self, events: Iterable[Tuple[int, Union[bytes, EncodedFragment]]]) -> bytes:
+        """
+        Encodes next part of track events.
+        :param events: (absolute time in ticks, midi message) tuples ordered by time.
+        Instead of a message there can be an encoded fragment, time is fragment start time then.
+        Events are written as they come, without sorting.
+        """
+        result = bytearray()
+        previous_tick = self.previous_tick
+        running_status = self.running_status
+
+        for tick, message in events:
+            if message.__class__ is EncodedFragment:
+                fragment = message
+                tick_offset = tick
+                tick += fragment.first_tick
+                if tick < previous_tick:
+                    raise ValueError(f"Track events must be ordered by time, got event at tick {tick} "
+                                     f"after event at tick {previous_tick}")
+
+                result += encode_variable_length(tick - previous_tick)
+                message = fragment.first_message
+                if message[0] == running_status:
+                    result += message[1:]
+                else:
+                    result += message
+                result += fragment.data
+
+                previous_tick = tick_offset + fragment.last_tick
+                running_status = fragment.last_status
+                continue
+
+            if tick < previous_tick:
+                raise ValueError(f"Track events must be ordered by time, got event at tick {tick} "
+                                 f"after event at tick {previous_tick}")
+
+            result += encode_variable_length(tick - previous_tick)
+            previous_tick = tick
+
+            status = message[0]
+            if status >= 0xF0:
+                # meta and sysex events cancel running status
+                running_status = None
+                result += message
+            elif status == running_status:
+                # omit status byte if it's the same as in the previous channel message
+                result += message[1:]
+            else:
+                running_status = status
+                result += message
+
+        self.previous_tick = previous_tick
+        self.running_status = running_status
+        return bytes(result)
+
+    def finish(self) -> bytes:
+        """:return: end of track event, should be written after all the other events"""
+        return b"\x00" + END_OF_TRACK_MESSAGE
+
+
+def encode_track(events: Iterable[Tuple[int, bytes]]) -> bytes:
+    """
+    Encodes track events to MTrk chunk data (without chunk header).
+    :param events: (absolute time in ticks, midi message) tuples ordered by time.
+    Events are written as they come, without sorting.
+    :return: track data, including end of track event
+    """
+    encoder = TrackEncoder()
+    return encoder.encode(events) + encoder.finish()
+
+
+def write_header(output: BinaryIO, tracks_count: int,
+                 ticks_per_quarter_note: int = TICKS_PER_QUARTER_NOTE, file_format: int = 1):
+    output.write(b"MThd" + struct.pack(">LHHH", 6, file_format, tracks_count, ticks_per_quarter_note))
+
+
+def write_track(output: BinaryIO, track_data: bytes):
+    output.write(b"MTrk" + struct.pack(">L", len(track_data)))
+    output.write(track_data)
+
+
+def is_seekable(output: BinaryIO) -> bool:
+    try:
+        return output.seekable()
+    except (AttributeError, ValueError):
+        return False
+
+
+def is_appending(output: BinaryIO) -> bool:
+    """
+    :return: True if every write to output goes to the end of the file, e.g. stdout
+    redirected with >>. Such output can seek, but written data can't be patched
+    """
+    if "a" in getattr(output, "mode", ""):
+        return True
+    if fcntl is None:
+        return False
+    try:
+        return bool(fcntl.fcntl(output.fileno(), fcntl.F_GETFL) & os.O_APPEND)
+    except (AttributeError, ValueError, OSError):
+        # not a real file (e.g. BytesIO)
+        return False
+
+
+def write_track_stream(output: BinaryIO, events: Iterable[Tuple[int, Union[bytes, EncodedFragment]]]):
+    """
+    Encodes and writes track chunk as events come, without keeping
+    the whole track in memory. Chunk length is not known until the
+    track is over, so a placeholder is written and patched afterwards -
+    output must be seekable.
+    :param events: (absolute time in ticks, midi message or EncodedFragment) tuples ordered by time.
+    """
+    header_position = output.tell()
+    output.write(b"MTrk" + struct.pack(">L", 0))
+
+    encoder = TrackEncoder()
+    length = 0
+    part = []
+    for event in events:
+        part.append(event)
+        if len(part) >= STREAM_PART_LENGTH:
+            data = encoder.encode(part)
+            output.write(data)
+            length += len(data)
+            part.clear()
+
+    data = encoder.encode(part) + encoder.finish()
+    output.write(data)
+    length += len(data)
+
+    end_position = output.tell()
+    output.seek(header_position + 4)
+    output.write(struct.pack(">L", length))
+    output.seek(end_position)
+
+
+def write_midi_stream(output: BinaryIO, tracks: Iterable[Iterable[Tuple[int, Union[bytes, EncodedFragment]]]],
+                      tracks_count: int, ticks_per_quarter_note: int = TICKS_PER_QUARTER_NOTE):
+    """
+    Writes format 1 midi file track by track, consuming events of every
+    track lazily, so memory used does not depend on the length of the tracks.
+    If output is not seekable (e.g. it's a pipe or stdout) or is opened for appending,
+    every track is spooled to a temporary file first, since chunk length
+    has to be written before the track data.
+    :param output: binary file-like object to write to
+    :param tracks: event iterables, one per track; every iterable yields
+    (absolute time in ticks, midi message or EncodedFragment) tuples ordered by time
+    :param tracks_count: number of tracks (it's written in header before tracks are consumed)
+    :param ticks_per_quarter_note: midi time resolution
+    """
+    write_header(output, tracks_count=tracks_count, ticks_per_quarter_note=ticks_per_quarter_note)
+
+    if is_seekable(output) and not is_appending(output):
+        for events in tracks:
+            write_track_stream(output, events)
+        return
+
+    with tempfile.TemporaryFile() as spool:
+        for events in tracks:
+            spool.seek(0)
+            spool.truncate()
+            write_track_stream(spool, events)
+            spool.seek(0)
+            shutil.copyfileobj(spool, output, STREAM_BUFFER_SIZE)
+
+
+class StandardMidiFile:
+    """
+    Collects events for multiple tracks and writes them as format 1 midi file.
+
+    Implements the part of MIDIUtil's MIDIFile interface that exporters
+    use (addNote, addControllerEvent, addTempo, addTrackName, writeFile), so it works as a drop-in
+    replacement for it. Same as in MIDIUtil, the first track in the file is
+    a tempo track, so track numbers passed to the methods are shifted by one.
+    Times are passed in beats (quarter notes).
+    """
+
+    def __init__(self, numTracks: int, ticks_per_quarter_note: int = TICKS_PER_QUARTER_NOTE):
+        self.ticks_per_quarter_note = ticks_per_quarter_note
+        # events of every track as (tick, order, pitch, message) tuples
+        self.tracks: List[List[tuple]] = [[] for _ in range(numTracks + 1)]
+
+    def time_to_ticks(self, time: float) -> int:
+        return int(time * self.ticks_per_quarter_note)
+
+    def addNote(self, track: int, channel: int, pitch: int, time: float, duration: float, volume: int):
+        self.add_note_ticks(track=track, channel=channel, pitch=pitch,
+                            start_tick=self.time_to_ticks(time),
+                            duration_ticks=self.time_to_ticks(duration),
+                            volume=volume)
+
+    def add_note_ticks(self, track: int, channel: int, pitch: int,
+                       start_tick: int, duration_ticks: int, volume: int):
+        """Same as addNote(), but time and duration are passed in integer ticks"""
+        events = self.tracks[track + 1]
+        events.append((start_tick, ORDER_NOTE_ON, pitch, note_on_message(channel, pitch, volume)))
+        events.append((start_tick + duration_ticks, ORDER_NOTE_OFF, pitch,
+                       note_off_message(channel, pitch)))
+
+    def addControllerEvent(self, track: int, channel: int, time: float, controller_number: int, parameter: int):
+        self.add_control_change_ticks(track=track, channel=channel, tick=self.time_to_ticks(time),
+                                      controller=controller_number, value=parameter)
+
+    def add_control_change_ticks(self, track: int, channel: int, tick: int, controller: int, value: int):
+        """Same as addControllerEvent(), but time is passed in integer ticks"""
+        self.tracks[track + 1].append((tick, ORDER_CONTROL, controller,
+                                       control_change_message(channel, controller, value)))
+
+    def addTempo(self, track: int, time: float, tempo: float):
+        # tempo always goes to the tempo track
+        self.tracks[0].append((self.time_to_ticks(time), ORDER_META, 0, tempo_message(tempo)))
+
+    def addTrackName(self, track: int, time: float, trackName: str):
+        self.tracks[track + 1].append((self.time_to_ticks(time), ORDER_META, 0, track_name_message(trackName)))
+
+    def writeFile(self, fileHandle: BinaryIO):
+        write_header(fileHandle, tracks_count=len(self.tracks), ticks_per_quarter_note=self.ticks_per_quarter_note)
+
+        for events in self.tracks:
+            # events are added in no particular order, so they are sorted once here
+            events.sort()
+            write_track(fileHandle, encode_track((event[0], event[3]) for event in events))
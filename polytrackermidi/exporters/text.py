@@ -0,0 +1,30 @@
+# Plain text exporters
+
+__author__ = "Alexey 'DataGreed' Strelkov"
+
+from polytrackermidi.parsers.patterns import Pattern
+
+
+class PatternToTextExporter:
+    """
+    Exports pattern as text: either as a table of steps that looks
+    like the tracker screen or as a list of notes that are actually played
+    (with chords and arps resolved), taken from compiled note events
+    """
+
+    def __init__(self, pattern: Pattern, list_notes: bool = False):
+        """
+        :param pattern: pattern to export
+        :param list_notes: export list of played notes instead of step table
+        """
+        self.pattern = pattern
+        self.list_notes = list_notes
+
+    def generate_text(self) -> str:
+        if self.list_notes:
+            return self.pattern.get_note_events().render_as_text()
+        return self.pattern.render_as_table()
+
+    def write_text_file(self, path: str):
+        with open(path, 'w') as out:
+            out.write(self.generate_text())
@@ -1 +1 @@
-__all__ = ['arps', 'chords', 'constants', 'patterns', 'project']
\ No newline at end of file
+__all__ = ['arps', 'chords', 'constants', 'events', 'patterns', 'project']
\ No newline at end of file
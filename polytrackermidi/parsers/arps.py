@@ -1,9 +1,39 @@
 import itertools
 import random
 from enum import Enum
+from typing import List, Sequence, Tuple, Union
 
 from polytrackermidi.parsers.chords import Chord
 
+# seed of random arps used by default, so exports are reproducible
+DEFAULT_SEED = 0
+
+
+def make_seed(seed: Union[int, random.Random, None]) -> int:
+    """
+    Converts seed passed to exporters to an integer seed.
+    :param seed: integer seed, random.Random instance to draw a seed from
+    or None for default seed
+    """
+    if seed is None:
+        return DEFAULT_SEED
+    if isinstance(seed, random.Random):
+        return seed.getrandbits(64)
+    return seed
+
+
+def get_step_random(seed: int, pattern_crc: int, track_number: int, step_number: int) -> random.Random:
+    """
+    Creates random number generator for a random arp played at the step of a pattern.
+    It only depends on the seed, pattern contents and position of the step,
+    so random arps are the same no matter in which order (or in which process)
+    patterns are rendered.
+    :param seed: export seed, see make_seed()
+    :param pattern_crc: crc32 of pattern payload
+    """
+    return random.Random((((seed << 32) | pattern_crc) << 16) | (track_number << 8) | step_number)
+
+
 class ArpDirection(Enum):
     raising = 1
     falling = -1
@@ -14,8 +44,12 @@ class EndlessRandomIterator(object):
     Iterates endlessly on a provided list,
     returning random values from it each time
     """
-    def __init__(self, iterable:list):
+    def __init__(self, iterable:list, rng: random.Random = None):
+        """
+        :param rng: random number generator to use, global one by default
+        """
         self.iterable = iterable
+        self.rng = rng or random
         if not iterable:
             raise ValueError
 
@@ -23,16 +57,73 @@ class EndlessRandomIterator(object):
         return self
 
     def __next__(self):
-        return random.choice(self.iterable)
+        return self.rng.choice(self.iterable)
         # raise StopIteration
 
+def get_pitch_iterator(pitches: tuple, direction: ArpDirection, rng: random.Random = None):
+    """
+    Creates new endless iterator over midi pitches of a chord in the direction
+    of arpeggiation. Same as Arp.get_notes_iterator(), but for plain pitch values
+    :param rng: random number generator for random arps, global one by default
+    """
+    if direction == ArpDirection.raising:
+        return itertools.cycle(pitches)
+    elif direction == ArpDirection.falling:
+        return itertools.cycle(reversed(pitches))
+    elif direction == ArpDirection.random:
+        return EndlessRandomIterator(pitches, rng)
+
+    else:
+        raise ValueError(f"Unsupported arp direction: {direction}")
+
+
+def get_division_ticks(division: float, ticks_per_step: int) -> int:
+    """
+    Converts arp division (in steps, can be fractional) to integer ticks.
+    Divisions are rounded to the nearest tick, so e.g. .3 division
+    at 240 ticks per step is exactly 80 ticks
+    """
+    return max(1, round(division * ticks_per_step))
+
+
+def expand_arp(pitches: Sequence[int], direction: ArpDirection, division_ticks: int,
+               start_tick: int, stop_tick: int, rng: random.Random = None) -> Tuple[List[int], List[int], List[int]]:
+    """
+    Computes the whole note schedule of an arpeggio at once.
+    Notes are played one after another every division_ticks starting
+    at start_tick, the last note is shortened so that it ends exactly at stop_tick.
+    :param pitches: midi pitches of the chord that is arpeggiated
+    :param direction: direction of arpeggiation
+    :param division_ticks: duration of every note in ticks
+    :param start_tick: tick at which arp starts playing
+    :param stop_tick: tick at which arp stops playing (next note, OFF/CUT/FAD,
+                      step with arp fx set to 0 or end of pattern)
+    :param rng: random number generator for random arps, global one by default.
+                Pass a generator from get_step_random() to get reproducible arps
+    :return: (start ticks, durations in ticks, midi pitches) lists of the same length
+    """
+    if stop_tick <= start_tick:
+        return [], [], []
+
+    # arps are at most a pattern long, so plain lists are faster
+    # than any vectorized computation here
+    starts = list(range(start_tick, stop_tick, division_ticks))
+    count = len(starts)
+    durations = [division_ticks] * count
+    durations[-1] = stop_tick - starts[-1]
+
+    notes_pitches = list(itertools.islice(get_pitch_iterator(pitches, direction, rng), count))
+
+    return starts, durations, notes_pitches
+
+
 class Arp:
     def __init__(self, chord: Chord, direction: ArpDirection, division: float):
         self.division = division
         self.direction = direction
         self.chord = chord
 
-    def get_notes_iterator(self):
+    def get_notes_iterator(self, rng: random.Random = None):
         """
         Creates new endless iterator over chord
         notes in the direction of arpeggiation.
@@ -48,7 +139,7 @@ class Arp:
         elif self.direction == ArpDirection.random:
             # I have no idea what kind of algo tracker implements - they could probably
             # always generate different notes to avoid placing two same notes in a row (or not)
-            return EndlessRandomIterator(self.chord.notes)
+            return EndlessRandomIterator(self.chord.notes, rng)
 
         else:
             raise ValueError(f"Unsupported arp direction: {self.direction}")
@@ -183,3 +274,10 @@ SUPPORTED_ARP_TYPES = [
 
 # mapping tracker value: arp type object
 ARP_TYPES_BY_VALUE = {item.value: item for item in SUPPORTED_ARP_TYPES}
+
+# arp types indexed by arp fx value (None for values that are not arps)
+ARP_TYPES_BY_FX_VALUE = tuple(ARP_TYPES_BY_VALUE.get(value) for value in range(0x100))
+
+# (direction, division) tuples indexed by arp fx value (None for values that are not arps)
+ARP_PARAMETERS_BY_FX_VALUE = tuple((item.direction, item.division) if item else None
+                                   for item in ARP_TYPES_BY_FX_VALUE)
@@ -208,3 +208,26 @@ CHORD_TYPES_BY_VALUE = {item.value: item for item in SUPPORTED_CHORD_TYPES}
 
 # chord mapping by interval tuple (tuple, not list, as lists are not hashable)
 CHORD_TYPES_BY_INTERVAL_TUPLE = {tuple(item.intervals): item for item in SUPPORTED_CHORD_TYPES}
+
+# chord types indexed by chord fx value (None for values that are not chords)
+CHORD_TYPES_BY_FX_VALUE = tuple(CHORD_TYPES_BY_VALUE.get(value) for value in range(0x100))
+
+
+def build_chord_midi_pitches() -> tuple:
+    """
+    Precomputes midi pitches of every supported chord for every
+    audible root note value, so rendering a chord is a single lookup.
+    :return: tuple indexed by (root note value << 8) | chord fx value.
+    Items are tuples of midi pitches or None if there is no such chord.
+    """
+    table = [None] * 0x10000
+    for root_note_value in range(Note.OFF_VALUE):   # values starting from OFF are not notes
+        root_pitch = root_note_value + Note.MIDI_NOTE_OFFSET
+        for chord_type in SUPPORTED_CHORD_TYPES:
+            table[(root_note_value << 8) | chord_type.value] = tuple(
+                root_pitch + interval for interval in chord_type.intervals)
+    return tuple(table)
+
+
+# midi pitches of chords indexed by (root note value << 8) | chord fx value
+CHORD_MIDI_PITCHES = build_chord_midi_pitches()
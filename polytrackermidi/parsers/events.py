@@ -0,0 +1,247 @@
+# Compiled representation of pattern notes and automation.
+# Patterns are compiled once to a table of note events that all exporters
+# consume, so steps, chords, arps and effects are resolved in a single place.
+
+__author__ = "Alexey 'DataGreed' Strelkov"
+
+import zlib
+from array import array
+from typing import Iterator, List, Tuple
+
+from polytrackermidi.parsers import arps
+from polytrackermidi.parsers.patterns import EffectType, Note, Pattern, Step, EFFECT_DESCRIPTORS
+
+# tracker step is 1/16 note, so at midi resolution of 960 ticks
+# per quarter note (the one exporters use by default) it's 240 ticks
+DEFAULT_TICKS_PER_STEP = 240
+
+# default note velocity, 0-127, as per the MIDI standard
+DEFAULT_VELOCITY = 127
+
+# highest value of midi velocity and controllers
+MIDI_MAX_VALUE = 127
+
+# midi controller number of pan position
+MIDI_CONTROLLER_PAN = 10
+
+
+def fx_value_to_midi(effect_type: EffectType, value: int) -> int:
+    """
+    Scales effect value (e.g. volume 0...100) to midi value range 0...127.
+    Panning center (50) becomes midi pan center (64).
+    """
+    max_value = EFFECT_DESCRIPTORS[effect_type.value].max_value
+    return min(MIDI_MAX_VALUE, round(value * MIDI_MAX_VALUE / max_value))
+
+
+def get_step_velocity(step: Step) -> int:
+    """Velocity of notes played by the step: volume fx value if set, default velocity if not"""
+    volume = step.get_effect_value(EffectType.volume)
+    if volume is None:
+        return DEFAULT_VELOCITY
+    # note on with zero velocity is a note off in midi,
+    # so the quietest note is written with the lowest velocity instead
+    return max(1, fx_value_to_midi(EffectType.volume, volume))
+
+
+class NoteEventTable:
+    """
+    Notes of a pattern as a table with a column per note property.
+    Columns are stored in compact arrays, every row is a note that
+    starts playing at start tick (relative to the start of the pattern)
+    and lasts for duration ticks.
+    Automation (e.g. panning) is stored the same way in a separate set
+    of control columns, every control row sets midi controller of the
+    instrument to a value at a tick.
+    """
+
+    # names of columns in the order they are returned in rows
+    FIELDS = ("track", "instrument", "pitch", "start_tick", "duration", "velocity")
+
+    def __init__(self, ticks_per_step: int = DEFAULT_TICKS_PER_STEP, length: int = 0):
+        """
+        :param ticks_per_step: time resolution of the table, ticks per tracker step
+        :param length: pattern length in steps
+        """
+        self.ticks_per_step = ticks_per_step
+        self.length = length
+
+        self.tracks = array("B")
+        self.instruments = array("B")
+        # chords on high notes can go above 255 in theory, so pitches are 16 bit
+        self.pitches = array("H")
+        self.start_ticks = array("L")
+        self.durations = array("L")
+        self.velocities = array("B")
+
+        self.control_tracks = array("B")
+        self.control_instruments = array("B")
+        self.controllers = array("B")
+        self.control_ticks = array("L")
+        self.control_values = array("B")
+
+    @property
+    def length_ticks(self) -> int:
+        """pattern length in ticks"""
+        return self.length * self.ticks_per_step
+
+    def append(self, track: int, instrument: int, pitch: int, start_tick: int, duration: int,
+               velocity: int = DEFAULT_VELOCITY):
+        self.tracks.append(track)
+        self.instruments.append(instrument)
+        self.pitches.append(pitch)
+        self.start_ticks.append(start_tick)
+        self.durations.append(duration)
+        self.velocities.append(velocity)
+
+    def extend(self, track: int, instrument: int, pitches: List[int], start_ticks: List[int],
+               durations: List[int], velocity: int = DEFAULT_VELOCITY):
+        """Adds multiple notes of the same track and instrument at once, e.g. an arpeggio"""
+        count = len(pitches)
+        self.tracks.extend([track] * count)
+        self.instruments.extend([instrument] * count)
+        self.pitches.extend(pitches)
+        self.start_ticks.extend(start_ticks)
+        self.durations.extend(durations)
+        self.velocities.extend([velocity] * count)
+
+    def append_control(self, track: int, instrument: int, controller: int, tick: int, value: int):
+        self.control_tracks.append(track)
+        self.control_instruments.append(instrument)
+        self.controllers.append(controller)
+        self.control_ticks.append(tick)
+        self.control_values.append(value)
+
+    def iter_controls(self) -> Iterator[Tuple[int, int, int, int, int]]:
+        """iterates over automation as (track, instrument, controller, tick, value) tuples"""
+        return zip(self.control_tracks, self.control_instruments, self.controllers,
+                   self.control_ticks, self.control_values)
+
+    def __len__(self):
+        return len(self.pitches)
+
+    def __iter__(self) -> Iterator[Tuple[int, int, int, int, int, int]]:
+        """iterates over notes as (track, instrument, pitch, start tick, duration, velocity) tuples"""
+        return zip(self.tracks, self.instruments, self.pitches,
+                   self.start_ticks, self.durations, self.velocities)
+
+    def get_instruments(self) -> List[int]:
+        """sorted numbers of instruments that play notes"""
+        return sorted(set(self.instruments))
+
+    def render_as_text(self) -> str:
+        """
+        Lists notes ordered by time, one per line.
+        Time is printed as step number and tick offset within the step.
+        """
+        result = ["  Step  Tick | Track | Instr | Note | Length | Vel"]
+
+        for track, instrument, pitch, start_tick, duration, velocity in sorted(
+                self, key=lambda row: (row[3], row[0], row[2])):
+            step_number, tick = divmod(start_tick, self.ticks_per_step)
+            note = Note(value=pitch - Note.MIDI_NOTE_OFFSET)
+            result.append(f"{step_number+1:6} {tick:5} | {track+1:5} | {instrument:5} | "
+                          f"{str(note):>4} | {duration:6} | {velocity:3}")
+
+        return "\n".join(result)
+
+    @staticmethod
+    def from_pattern(pattern: Pattern, ticks_per_step: int = DEFAULT_TICKS_PER_STEP,
+                     seed: int = arps.DEFAULT_SEED) -> "NoteEventTable":
+        """
+        Compiles pattern to a table of notes: resolves note durations,
+        chords, arpeggios and volume of every step and panning automation.
+        Prefer Pattern.get_note_events() that caches compiled table.
+        :param seed: seed of random arps. Notes of a random arp depend only on the seed,
+        pattern contents and position of the arp, see arps.get_step_random()
+        """
+        # all track lengths are the same as of firmware 1.5
+        table = NoteEventTable(ticks_per_step=ticks_per_step, length=pattern.tracks[0].length)
+
+        # computed only if pattern has random arps
+        pattern_crc = None
+
+        for track_number, track in enumerate(pattern.tracks):
+
+            # positions where notes and arps end are precomputed per track
+            note_end_positions = track.get_note_end_positions()
+            arp_stop_positions = track.get_arp_stop_positions()
+
+            # empty steps are skipped
+            for step_number, step in track.iter_occupied_steps():
+
+                if step.note.is_off_fad_or_cut():
+                    # note off events are not stored, notes have durations instead
+                    continue
+
+                # we've got a note
+                # it lasts until the next note or NOTE OFF appears on this track
+                # or until the end of the pattern (not at the last step of the pattern)
+                start_tick = step_number * ticks_per_step
+                duration = (note_end_positions[step_number] - step_number) * ticks_per_step
+
+                # chords and arps are looked up in precomputed tables
+                chord_pitches = step.get_chord_midi_pitches()
+                # arpeggio works only with chord fx at the same step
+                arp_parameters = step.get_arp_parameters() if chord_pitches else None
+
+                # all notes of chords and arps are played with the same velocity
+                velocity = get_step_velocity(step)
+
+                if arp_parameters:
+                    # arpeggio
+                    arp_direction, arp_division = arp_parameters
+
+                    rng = None
+                    if arp_direction is arps.ArpDirection.random:
+                        if pattern_crc is None:
+                            pattern_crc = zlib.crc32(pattern.to_bytes())
+                        rng = arps.get_step_random(seed, pattern_crc, track_number, step_number)
+
+                    # every note has a length of arp division
+                    # (arp division is basically number of 1/16steps each note is played,
+                    # can be fractional), notes play one after another until the
+                    # next note, CUT/FAD/OFF event, step with arp fx set to 0
+                    # or end of pattern (actually end of the patter probably should not
+                    # end arp if there is a next pattern in song mode, but should do it if
+                    # we are rendering just one pattern, since we have to end sending notes
+                    # to midi file somewhere).
+                    # The whole arp is computed at once in integer ticks, so uneven
+                    # divisions like 1/3 and 1/6 do not drift and the last note
+                    # is shortened to end exactly where the arp stops
+                    arp_starts, arp_durations, arp_pitches = arps.expand_arp(
+                        chord_pitches, arp_direction,
+                        division_ticks=arps.get_division_ticks(arp_division, ticks_per_step),
+                        start_tick=start_tick,
+                        stop_tick=arp_stop_positions[step_number] * ticks_per_step,
+                        rng=rng)
+
+                    table.extend(track_number, step.instrument_number,
+                                 pitches=arp_pitches, start_ticks=arp_starts, durations=arp_durations,
+                                 velocity=velocity)
+
+                elif chord_pitches:
+                    # chord
+                    count = len(chord_pitches)
+                    table.extend(track_number, step.instrument_number,
+                                 pitches=chord_pitches, start_ticks=[start_tick] * count,
+                                 durations=[duration] * count, velocity=velocity)
+
+                else:
+                    # note that notes played by the same instrument can overlap
+                    # with themselves. MIDIUtil used to crash on that
+                    # (https://github.com/MarkCWirt/MIDIUtil/issues/34), native
+                    # midi writer just writes events in time order
+
+                    # default case - just a regular single note playing
+                    table.append(track_number, step.instrument_number,
+                                 step.note.value + Note.MIDI_NOTE_OFFSET, start_tick, duration, velocity)
+
+            # panning can be changed at any step while the note is playing,
+            # repeated values are dropped by exporters, see optimizer.optimize_controls()
+            for step_number, instrument_number, panning in track.iter_effect_values(EffectType.panning):
+                table.append_control(track_number, instrument_number, MIDI_CONTROLLER_PAN,
+                                     step_number * ticks_per_step,
+                                     fx_value_to_midi(EffectType.panning, panning))
+
+        return table
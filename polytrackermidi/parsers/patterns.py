@@ -1,7 +1,19 @@
 # TODO: enums for fx types
+import functools
 import math
+import struct
+import zlib
+from collections.abc import Sequence
 from enum import Enum
-from typing import List, Union
+from typing import Callable, Iterator, List, Tuple, Union
+
+try:
+    # numpy is optional. If it's installed, pattern payloads
+    # are decoded with a single vectorized read instead of
+    # slicing bytes for every step
+    import numpy
+except ImportError:
+    numpy = None
 
 __author__ = "Alexey 'DataGreed' Strelkov"
 
@@ -14,10 +26,9 @@ class EffectType(Enum):
     # todo: add all effect types
 
     def short_name(self):
-        try:
-            return EFFECT_SHORT_NAMES[self.value]
-        except AttributeError:
-            return EFFECT_SHORT_NAMES[self]
+        # can also be called with raw fx type value from pattern file instead of EffectType
+        type_value = self.value if isinstance(self, EffectType) else self
+        return EFFECT_DESCRIPTORS[type_value].short_name
 
 
 # short names the way they are represented in tracker UI
@@ -30,88 +41,185 @@ EFFECT_SHORT_NAMES = {
 }
 
 
-class Effect:
-    def __init__(self, fx_type: Union[int, EffectType], fx_value: int):
+class EffectDescriptor:
+    """
+    Describes how effect of a certain type is displayed and exported
+    """
+
+    def __init__(self, short_name: str, min_value: int = 0, max_value: int = 0xFF,
+                 formatter: Callable[[int], object] = None, midi_relevant: bool = False):
+        """
+        :param short_name: name the way it is displayed in tracker UI
+        :param min_value: lowest value that effect can have
+        :param max_value: highest value that effect can have
+        :param formatter: function that converts fx value to the way it's displayed
+        in tracker UI. Value is displayed as is if not set.
+        :param midi_relevant: True if effect affects exported midi
+        """
+        self.short_name = short_name
+        self.min_value = min_value
+        self.max_value = max_value
+        self.formatter = formatter or EffectDescriptor.format_raw_value
+        self.midi_relevant = midi_relevant
+
+    @staticmethod
+    def format_raw_value(value: int):
+        return value
+
+
+def format_chord_value(value: int):
+    from . import chords
+    chord_type = chords.CHORD_TYPES_BY_FX_VALUE[value]
+    return chord_type.render() if chord_type else value
+
+
+def format_arp_value(value: int):
+    from . import arps
+    arp_type = arps.ARP_TYPES_BY_FX_VALUE[value]
+    return arp_type.render() if arp_type else value
+
+
+def build_effect_descriptors() -> tuple:
+    """
+    Creates a table of 256 effect descriptors indexed by
+    fx type value the way it's stored in pattern file
+    """
+    # effects that has not been yet mapped out (and new effects that can be
+    # added in future firmware versions) are displayed with raw type value as name
+    descriptors = [EffectDescriptor(short_name=str(type_value)) for type_value in range(0x100)]
+
+    descriptors[EffectType.volume.value] = EffectDescriptor(
+        EFFECT_SHORT_NAMES[EffectType.volume.value], max_value=100, midi_relevant=True)
+    descriptors[EffectType.panning.value] = EffectDescriptor(
+        # 0 is -50 (left) and 50 is center
+        EFFECT_SHORT_NAMES[EffectType.panning.value], max_value=100, midi_relevant=True)
+    descriptors[EffectType.chord.value] = EffectDescriptor(
+        EFFECT_SHORT_NAMES[EffectType.chord.value], max_value=29,
+        formatter=format_chord_value, midi_relevant=True)
+    descriptors[EffectType.arp.value] = EffectDescriptor(
+        EFFECT_SHORT_NAMES[EffectType.arp.value], max_value=33,
+        formatter=format_arp_value, midi_relevant=True)
+
+    return tuple(descriptors)
+
+
+# effect descriptors indexed by fx type value from pattern file
+EFFECT_DESCRIPTORS = build_effect_descriptors()
+
+
+# mapping fx type value from pattern file: EffectType
+EFFECT_TYPES_BY_VALUE = {item.value: item for item in EffectType}
+
+
+class Immutable:
+    """
+    Base class for value objects that are shared between
+    steps and patterns, so they must never be changed after creation
+    """
+    __slots__ = ()
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"{type(self).__name__} objects are immutable")
+
+    def __delattr__(self, key):
+        raise AttributeError(f"{type(self).__name__} objects are immutable")
+
+
+class Effect(Immutable):
 
-        self.type = fx_type  # todo: ditch this ambiguous field. Use type_value and type_obj instead
-        self.value = fx_value
+    __slots__ = ("type", "value", "type_value", "type_obj", "descriptor")
+
+    def __new__(cls, fx_type: Union[int, EffectType], fx_value: int):
+
+        if isinstance(fx_type, int) and 0 <= fx_type <= 0xFF and 0 <= fx_value <= 0xFF:
+            # there are only 256x256 effects that can be stored in a pattern file,
+            # so every one of them is created once and then shared
+            index = (fx_type << 8) | fx_value
+            effect = _EFFECTS[index]
+            if effect is None:
+                effect = _EFFECTS[index] = cls._create(fx_type, fx_value)
+            return effect
+
+        return cls._create(fx_type, fx_value)
+
+    @classmethod
+    def _create(cls, fx_type: Union[int, EffectType], fx_value: int) -> "Effect":
+
+        effect = object.__new__(cls)
 
         # declare type_value and type_obj depending on the type of fx_type
         # (it can be value from tracker pattern file or actual EffectType enum value)
         if isinstance(fx_type, int):
-
-            self.type_value = fx_type
-            try:
-                self.type_obj = EffectType(self.type_value)
-            except ValueError as e:
-                # that's okay for now as we don't have all of the fx types described
-                # todo: describe all effect types in EffectType enum
-                self.type_obj = None
+            type_value = fx_type
+            # that's okay for now as we don't have all of the fx types described
+            # todo: describe all effect types in EffectType enum
+            type_obj = EFFECT_TYPES_BY_VALUE.get(type_value)
 
         elif isinstance(fx_type, EffectType):
-            self.type_obj = fx_type
-            self.type_value = fx_type.value
+            type_obj = fx_type
+            type_value = fx_type.value
 
         else:
             raise ValueError(f"fx_type must be int or EffectType, got {type(fx_type)} instead")
 
+        if 0 <= type_value <= 0xFF:
+            descriptor = EFFECT_DESCRIPTORS[type_value]
+        else:
+            descriptor = EffectDescriptor(short_name=str(type_value))
+
+        # todo: ditch this ambiguous field. Use type_value and type_obj instead
+        object.__setattr__(effect, "type", fx_type)
+        object.__setattr__(effect, "value", fx_value)
+        object.__setattr__(effect, "type_value", type_value)
+        object.__setattr__(effect, "type_obj", type_obj)
+        object.__setattr__(effect, "descriptor", descriptor)
+
         # todo: write down all effect types in a enum and check range of values for each of them
         #  so we we can have a human-readable version.
         # todo: ditch the Union[int, EffectType] when all effects will be described and separate
         # effect type value and actual object type in different variable
 
+        return effect
+
+    def __reduce__(self):
+        return Effect, (self.type, self.value)
+
     def get_name(self):
-        try:
-            return EffectType.short_name(self.type)
-        except KeyError:
-            # for effects that has not been yet mapped out and for future compatibility
-            # in case new effects will be added
-            return str(self.type)
+        # effects that has not been yet mapped out are named after their type value
+        return self.descriptor.short_name
 
     def get_chord_type(self):
-        if self.type_obj == EffectType.chord and self.value:
+        if self.type_obj is EffectType.chord and self.value:
             from . import chords
-            chord_type = chords.ChordType.get_by_fx_value(self.value)
-
-            return chord_type
+            return chords.CHORD_TYPES_BY_FX_VALUE[self.value]
         return None
 
     def get_arp_type(self):
-        if self.type_obj == EffectType.arp and self.value:
+        if self.type_obj is EffectType.arp and self.value:
             from . import arps
-            arp_type = arps.ArpType.get_by_fx_value(self.value)
-
-            return arp_type
+            return arps.ARP_TYPES_BY_FX_VALUE[self.value]
         return None
 
     def get_value_display(self):
-
-        # handle special cases for rendering values
-        if self.type_obj == EffectType.chord:
-            # print("ENCOUNTERED CHORD")
-            if self.value:
-                chord_type = self.get_chord_type()
-                return chord_type.render()
-
-        elif self.type_obj == EffectType.arp:
-            if self.value:
-                arp_type = self.get_arp_type()
-                return arp_type.render()
-
-        return self.value
+        # special cases for rendering values (e.g. chord names) are handled by formatter
+        return self.descriptor.formatter(self.value)
 
     def render(self, hide_value_if_no_type_set=True):
         # tracker stores fx values even for deleted effects.
-        # TODO: use names when we have all effect names mapped out in EffectType enum
-        return f"{self.get_name() if self.type else '--'}".rjust(3) + f"{self.get_value_display() if self.type else '---'}".rjust(4)
+        if not self.type:
+            return "--".rjust(3) + "---".rjust(4)
+        return self.descriptor.short_name.rjust(3) + f"{self.descriptor.formatter(self.value)}".rjust(4)
 
     def __str__(self):
 
         return self.render(hide_value_if_no_type_set=False)
 
 
+# shared Effect instances indexed by (type << 8) | value, filled in on first use
+_EFFECTS: List[Union[Effect, None]] = [None] * 0x10000
+
 
-class Note:
+class Note(Immutable):
 
     OFF_VALUE = 0xFC
     CUT_VALUE = 0xFD
@@ -125,21 +233,41 @@ class Note:
     # note names in the order they appear in octave in notation
     NOTE_NAMES = ("C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B")
 
-    def __init__(self, value: int):
-        self.value = value
+    # midi middle C (C4) is 60, tracker C4 is 48
+    MIDI_NOTE_OFFSET = 12
+
+    __slots__ = ("value", "octave", "name")
 
-        self.octave = math.floor(value/12)
-        self.name = Note.NOTE_NAMES[value % 12]
+    def __new__(cls, value: int):
+        if 0 <= value <= 0xFF:
+            # all the notes that can be stored in a pattern file are precomputed
+            return _NOTES[value]
+        return cls._create(value)
+
+    @classmethod
+    def _create(cls, value: int) -> "Note":
+        note = object.__new__(cls)
+
+        name = Note.NOTE_NAMES[value % 12]
 
         # special cases
         if value == Note.EMPTY_VALUE:
-            self.name = "---"
+            name = "---"
         elif value == Note.OFF_VALUE:
-            self.name = "OFF"
+            name = "OFF"
         elif value == Note.FADE_VALUE:
-            self.name = "FAD"
+            name = "FAD"
         elif value == Note.CUT_VALUE:
-            self.name = "CUT"
+            name = "CUT"
+
+        object.__setattr__(note, "value", value)
+        object.__setattr__(note, "octave", value // 12)
+        object.__setattr__(note, "name", name)
+
+        return note
+
+    def __reduce__(self):
+        return Note, (self.value,)
 
     def is_empty(self):
 
@@ -154,7 +282,11 @@ class Note:
         return f"{self.name}{self.octave}"
 
 
-class Step:
+# shared Note instances for every possible note value byte
+_NOTES = tuple(Note._create(value) for value in range(0x100))
+
+
+class Step(Immutable):
 
     # payload length in bytes
     PAYLOAD_LENGTH = 6
@@ -168,12 +300,21 @@ class Step:
     FX1_TYPE_OFFSET = 4
     FX1_VALUE_OFFSET = 5
 
+    __slots__ = ("note", "instrument_number", "fx1", "fx2")
+
+    # how many decoded steps are kept around for reuse. Most
+    # of the steps in a pattern are empty and identical
+    CACHE_SIZE = 4096
+
     def __init__(self, note:Note, instrument_number:int, fx1: Effect, fx2: Effect):
 
-        self.note = note
-        self.instrument_number = instrument_number
-        self.fx1 = fx1
-        self.fx2 = fx2
+        object.__setattr__(self, "note", note)
+        object.__setattr__(self, "instrument_number", instrument_number)
+        object.__setattr__(self, "fx1", fx1)
+        object.__setattr__(self, "fx2", fx2)
+
+    def __reduce__(self):
+        return Step, (self.note, self.instrument_number, self.fx1, self.fx2)
 
     def __str__(self):
 
@@ -188,12 +329,30 @@ class Step:
     def from_bytes(data: bytes):
 
         if len(data) != Step.PAYLOAD_LENGTH:
-            raise ValueError(f"Expected Step payload to be {Step.PAYLOAD_LENGTH} bytes long, got {len(bytes)} instead")
+            raise ValueError(f"Expected Step payload to be {Step.PAYLOAD_LENGTH} bytes long, got {len(data)} instead")
+
+        return Step.from_values(*data)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=CACHE_SIZE)
+    def from_values(note: int, instrument: int, fx2_type: int, fx2_value: int, fx1_type: int, fx1_value: int):
+        """
+        Constructs a step from raw values in the order
+        they are stored in pattern file (see STEP_FIELDS).
+        Steps are immutable, so steps with the same values are shared.
+        """
+        return Step(note=Note(note),
+                    instrument_number=instrument,
+                    fx1=Effect(fx_type=fx1_type, fx_value=fx1_value),
+                    fx2=Effect(fx_type=fx2_type, fx_value=fx2_value))
 
-        return Step(note=Note(data[Step.NOTE_OFFSET]),
-                    instrument_number=data[Step.INSTRUMENT_OFFSET],
-                    fx1=Effect(fx_type=data[Step.FX1_TYPE_OFFSET], fx_value=data[Step.FX1_VALUE_OFFSET]),
-                    fx2=Effect(fx_type=data[Step.FX2_TYPE_OFFSET], fx_value=data[Step.FX2_VALUE_OFFSET]))
+    def to_values(self) -> tuple:
+        """
+        Returns raw step values in the order they are stored in pattern file (see STEP_FIELDS)
+        """
+        return (self.note.value, self.instrument_number,
+                self.fx2.type_value, self.fx2.value,
+                self.fx1.type_value, self.fx1.value)
 
     def get_chord(self):
         """
@@ -207,6 +366,45 @@ class Step:
             return chord_type.get_chord(self.note)
         return None
 
+    def get_chord_midi_pitches(self) -> Union[tuple, None]:
+        """
+        Returns a tuple of midi pitches of the chord if this step has chord fx.
+        Returns None if not. Same as get_chord(), but uses precomputed
+        table instead of creating Chord and Note objects.
+        """
+        from . import chords
+        for fx in (self.fx1, self.fx2):
+            if fx.type_obj is EffectType.chord and fx.value:
+                pitches = chords.CHORD_MIDI_PITCHES[(self.note.value << 8) | fx.value]
+                if pitches:
+                    return pitches
+        return None
+
+    def get_effect_value(self, effect_type: EffectType) -> Union[int, None]:
+        """
+        Returns value of the effect of given type if this step has it
+        at any effect slot (the first one if both slots have it). Returns None if not.
+        """
+        for fx in (self.fx1, self.fx2):
+            if fx.type_obj is effect_type:
+                return fx.value
+        return None
+
+    def get_arp_parameters(self) -> Union[tuple, None]:
+        """
+        Returns (direction, division) tuple if this step has arp fx
+        at any effect slot. Returns None if not. Same as get_arp(),
+        but uses precomputed table instead of creating Arp objects.
+        Note: arp only plays if the step also has chord fx.
+        """
+        from . import arps
+        for fx in (self.fx1, self.fx2):
+            if fx.type_obj is EffectType.arp and fx.value:
+                parameters = arps.ARP_PARAMETERS_BY_FX_VALUE[fx.value]
+                if parameters:
+                    return parameters
+        return None
+
     def get_arp(self):
         """
         Returns arp if this step has arp fx at any effect slot. Returns None if not.
@@ -226,6 +424,33 @@ class Step:
         return None
 
 
+class LazyStepList(Sequence):
+    """
+    Read-only list of track steps that creates Step objects
+    from raw step values only when they are accessed
+    """
+
+    def __init__(self, step_values: List[tuple]):
+        """
+        :param step_values: a list of tuples ordered as STEP_FIELDS
+        """
+        self.step_values = step_values
+        self._steps = [None] * len(step_values)
+
+    def __len__(self):
+        return len(self._steps)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        step = self._steps[index]
+        if step is None:
+            step = Step.from_values(*self.step_values[index])
+            self._steps[index] = step
+        return step
+
+
 class Track:
 
     # track payload length in bytes
@@ -233,43 +458,199 @@ class Track:
     # number of sequencer steps in tracks (1/16 steps)
     NUMBER_OF_STEPS = 128
 
-    def __init__(self, length: int, steps: List[Step]):
+    def __init__(self, length: int, steps: List[Step] = None, step_values=None,
+                 occupied_steps: List[int] = None):
+        """
+        :param length: number of steps actually played in the track
+        :param steps: list of 128 Step objects
+        :param step_values: raw values of 128 steps to use instead of Step objects.
+        Either a numpy structured array of STEP_DTYPE or a list of tuples ordered
+        as STEP_FIELDS. Step objects are created from them only when accessed.
+        :param occupied_steps: ascending numbers of steps that are not empty, if already known.
+        """
+        if steps is not None:
+            step_values = [step.to_values() for step in steps]
+        elif step_values is None:
+            raise ValueError("Either steps or step_values must be passed to create a Track")
+
         self.length = length
-        self.steps = steps
+        self.step_values = step_values
+        self._steps = steps
+        self._step_rows = None
+        self._occupied_steps = occupied_steps
 
-        if len(steps) != 128:
-            raise ValueError(f"Track must have 128 steps, only {len(steps)} passed")
+        # next event boundary indexes, built on first use
+        self._note_end_positions = None
+        self._arp_stop_positions = None
+
+        if len(step_values) != 128:
+            raise ValueError(f"Track must have 128 steps, only {len(step_values)} passed")
 
         if length > 128 or length < 1:
             raise ValueError(f"Track length must be in 1...128 range. {length} passed instead")
 
+    @property
+    def step_rows(self) -> List[tuple]:
+        """
+        Raw values of all steps as a list of tuples ordered as STEP_FIELDS
+        """
+        if self._step_rows is None:
+            if numpy is not None and isinstance(self.step_values, numpy.ndarray):
+                # converting the whole array at once is much cheaper than
+                # converting numpy records one by one
+                self._step_rows = self.step_values.tolist()
+            else:
+                self._step_rows = self.step_values
+        return self._step_rows
+
+    @property
+    def steps(self) -> Sequence:
+        if self._steps is None:
+            self._steps = LazyStepList(self.step_rows)
+        return self._steps
+
+    @property
+    def occupied_steps(self) -> List[int]:
+        """
+        Ascending numbers of steps that have a note or OFF/CUT/FADE
+        (of all 128 steps, not only the ones within track length)
+        """
+        if self._occupied_steps is None:
+            self._occupied_steps = [step_number for step_number, values in enumerate(self.step_rows)
+                                    if values[0] != Note.EMPTY_VALUE]
+        return self._occupied_steps
+
+    def iter_occupied_steps(self):
+        """
+        Iterates over (step number, Step) pairs of steps within track length
+        that have a note or OFF/CUT/FADE. Empty steps are skipped without
+        creating Step objects for them, so sparse tracks are cheap to iterate.
+        """
+        steps = self.steps
+        for step_number in self.occupied_steps:
+            if step_number >= self.length:
+                break
+            yield step_number, steps[step_number]
+
+    def get_note_end_positions(self) -> List[int]:
+        """
+        Returns a list with position where a note played at
+        every step of the track ends: the next step with a note
+        or OFF/CUT/FADE or track length if there are no such steps after it.
+        Built once in a single reverse pass over the track, then cached.
+        """
+        if self._note_end_positions is None:
+            self._build_boundaries()
+        return self._note_end_positions
+
+    def get_arp_stop_positions(self) -> List[int]:
+        """
+        Returns a list with position where an arpeggio started at
+        every step of the track stops. Same as get_note_end_positions(),
+        but an arp also stops at steps with arp fx set to 0.
+        """
+        if self._arp_stop_positions is None:
+            self._build_boundaries()
+        return self._arp_stop_positions
+
+    def _build_boundaries(self):
+
+        rows = self.step_rows
+        arp_type_value = EffectType.arp.value
+
+        note_end_positions = [self.length] * self.length
+        arp_stop_positions = [self.length] * self.length
+
+        next_note_position = self.length
+        next_arp_stop_position = self.length
+
+        for step_number in range(self.length - 1, -1, -1):
+            note_end_positions[step_number] = next_note_position
+            arp_stop_positions[step_number] = next_arp_stop_position
+
+            note, _, fx2_type, fx2_value, fx1_type, fx1_value = rows[step_number]
+
+            if note != Note.EMPTY_VALUE:
+                # both next note and OFF/CUT/FADE end the note
+                next_note_position = step_number
+                next_arp_stop_position = step_number
+            elif (fx1_type == arp_type_value and not fx1_value) or (fx2_type == arp_type_value and not fx2_value):
+                # arp fx with zero value stops running arpeggio
+                next_arp_stop_position = step_number
+
+        self._note_end_positions = note_end_positions
+        self._arp_stop_positions = arp_stop_positions
+
+    def iter_effect_values(self, effect_type: EffectType) -> Iterator[Tuple[int, int, int]]:
+        """
+        Iterates over steps within track length that have effect of given type,
+        including steps without notes (effect changes sound of the note that is playing).
+        Steps before the first note of the track are skipped, since there is
+        no instrument they could be applied to.
+        :return: (step number, number of instrument the effect is applied to, effect value) tuples
+        """
+        rows = self.step_rows
+        type_value = effect_type.value
+        instrument_number = None
+
+        for step_number in range(self.length):
+            note, instrument, fx2_type, fx2_value, fx1_type, fx1_value = rows[step_number]
+
+            if note not in Note.INAUDIBLE_VALUES:
+                # effect applies to the instrument of the last played note
+                instrument_number = instrument
+
+            if instrument_number is None:
+                continue
+
+            if fx1_type == type_value:
+                yield step_number, instrument_number, fx1_value
+            elif fx2_type == type_value:
+                yield step_number, instrument_number, fx2_value
+
     def __str__(self):
         return " | ".join([str(x) for x in self.steps])
 
+    def to_bytes(self) -> bytes:
+        """
+        Encodes track back to payload the way it's stored in pattern file, see from_bytes()
+        """
+        # pattern length is zero-based
+        length = bytes((self.length - 1,))
+
+        if numpy is not None and isinstance(self.step_values, numpy.ndarray):
+            return length + self.step_values.tobytes()
+
+        return length + b"".join(struct.pack(STEP_STRUCT_FORMAT, *values) for values in self.step_rows)
+
     @staticmethod
     def from_bytes(data: bytes):
 
         if len(data) != Track.PAYLOAD_LENGTH:
             raise ValueError(f"Expected track payload {Track.PAYLOAD_LENGTH} bytes long, got {len(data)} instead")
 
-        pattern_length = data[0] + 1  # pattern length is zero-based, actual lowest length is 1
-
-        # remove pattern length for easier iteration
-        steps_data = data[1:]
-
-        steps = []
-
         # sanity check
-        if len(steps_data)/Track.NUMBER_OF_STEPS != Step.PAYLOAD_LENGTH:
+        if (len(data) - 1) / Track.NUMBER_OF_STEPS != Step.PAYLOAD_LENGTH:
             raise ValueError("Internal Error: track payload does not divide by number of steps as expected")
 
-        for i in range(Track.NUMBER_OF_STEPS):
-            start_offset = i * Step.PAYLOAD_LENGTH
-            end_offset = (i + 1) * Step.PAYLOAD_LENGTH
+        if numpy is not None:
+            track_values = numpy.frombuffer(data, dtype=TRACK_DTYPE, count=1)[0]
+            steps_values = track_values["steps"]
+            occupied_steps = numpy.flatnonzero(steps_values["note"] != Note.EMPTY_VALUE).tolist()
+            # pattern length is zero-based, actual lowest length is 1
+            return Track(length=int(track_values["length"]) + 1, step_values=steps_values,
+                         occupied_steps=occupied_steps)
+
+        pattern_length = data[0] + 1  # pattern length is zero-based, actual lowest length is 1
+
+        # skip pattern length and unpack all the steps in one go
+        step_values = list(struct.iter_unpack(STEP_STRUCT_FORMAT, data[1:]))
 
-            steps.append(Step.from_bytes(steps_data[start_offset:end_offset]))
+        # note is the first byte of every step
+        notes = data[1 + Step.NOTE_OFFSET::Step.PAYLOAD_LENGTH]
+        occupied_steps = [step_number for step_number, note in enumerate(notes) if note != Note.EMPTY_VALUE]
 
-        return Track(length=pattern_length, steps=steps)
+        return Track(length=pattern_length, step_values=step_values, occupied_steps=occupied_steps)
 
 
 class Pattern:
@@ -284,6 +665,59 @@ class Pattern:
         if len(tracks) != Pattern.NUMBER_OF_TRACKS:
             raise ValueError(f"Pattern must have {Pattern.NUMBER_OF_TRACKS} tracks, got only {len(tracks)}")
 
+        self._summary = None
+        # compiled note event tables indexed by (ticks per step, random arps seed)
+        self._note_events = {}
+
+    def get_summary(self) -> "PatternSummary":
+        """
+        Returns pattern statistics (used instruments, number of notes, etc.).
+        Computed once from occupied steps only, then cached.
+        """
+        if self._summary is None:
+            self._summary = PatternSummary.from_pattern(self)
+        return self._summary
+
+    def get_note_events(self, ticks_per_step: int = None, seed: int = None) -> "NoteEventTable":
+        """
+        Returns notes of the pattern compiled to a table of note events
+        (resolved durations, chords and arps). Compiled once per resolution and seed, then cached.
+        Exporters should use it instead of walking pattern steps.
+        :param ticks_per_step: time resolution, 240 ticks per step (960 per quarter note) by default
+        :param seed: seed of random arps, see NoteEventTable.from_pattern()
+        """
+        # local import to avoid circular imports
+        from polytrackermidi.parsers.arps import DEFAULT_SEED
+        from polytrackermidi.parsers.events import NoteEventTable, DEFAULT_TICKS_PER_STEP
+
+        if ticks_per_step is None:
+            ticks_per_step = DEFAULT_TICKS_PER_STEP
+        if seed is None:
+            seed = DEFAULT_SEED
+
+        key = (ticks_per_step, seed)
+        table = self._note_events.get(key)
+        if table is None:
+            table = self._note_events[key] = NoteEventTable.from_pattern(self, ticks_per_step, seed)
+        return table
+
+    def __reduce__(self):
+        # pattern is pickled as its compressed payload (mostly empty steps
+        # compress very well), so sending patterns to other processes is cheap.
+        # Step objects and cached compiled events are created again when needed
+        return Pattern.from_packed_bytes, (pack_payload(self.to_bytes()),)
+
+    def to_bytes(self) -> bytes:
+        """
+        Encodes pattern back to payload the way it's stored in pattern file, see from_bytes()
+        """
+        return b"".join(track.to_bytes() for track in self.tracks)
+
+    @staticmethod
+    def from_packed_bytes(data: bytes) -> "Pattern":
+        """Constructs a pattern from payload compressed with pack_payload()"""
+        return Pattern.from_bytes(unpack_payload(data))
+
     def __str__(self):
         # TODO: add vertical printing option for easy comparision with actual tracker output
         result = ""
@@ -305,10 +739,32 @@ class Pattern:
         header_items = [f"Track {x+1}".center(21) for x in range(Pattern.NUMBER_OF_TRACKS)]
         result.append(" | ".join(header_items) + " ")
 
-        for i in range(self.tracks[0].length):  # all track lengths are the same as of firmware 1.5
-            line_data = []
-            for track in self.tracks:
-                line_data.append(str(track.steps[i].render_as_table_cell()))
+        length = self.tracks[0].length  # all track lengths are the same as of firmware 1.5
+
+        # steps without notes mostly look the same, so they are rendered
+        # once for every unique combination of values
+        empty_cells = {}
+
+        columns = []
+        for track in self.tracks:
+            column = [None] * length
+            for step_number, step in track.iter_occupied_steps():
+                if step_number < length:
+                    column[step_number] = step.render_as_table_cell()
+
+            rows = track.step_rows
+            for step_number in range(length):
+                if column[step_number] is None:
+                    values = rows[step_number]
+                    cell = empty_cells.get(values)
+                    if cell is None:
+                        cell = empty_cells[values] = Step.from_values(*values).render_as_table_cell()
+                    column[step_number] = cell
+
+            columns.append(column)
+
+        for i in range(length):
+            line_data = [column[i] for column in columns]
 
             result.append(" | ".join(line_data) + " ")
 
@@ -317,6 +773,12 @@ class Pattern:
 
     @staticmethod
     def from_bytes(data: bytes):
+        """
+        Constructs a pattern from pattern payload extracted from pattern file.
+        :param data: pattern payload. Can be any bytes-like object, e.g. memoryview
+        over file bytes (see read_file_buffer()) - tracks are decoded from views over it,
+        the payload itself is not copied.
+        """
 
         expected_length = Pattern.OFFSET_END - Pattern.OFFSET_START # 6152 or 769*8 just for sanity check
 
@@ -329,6 +791,21 @@ class Pattern:
 
         tracks = []
 
+        if numpy is not None:
+            # read the whole payload at once as (8 tracks x 128 steps) table,
+            # tracks are just views over it
+            tracks_values = numpy.frombuffer(data, dtype=TRACK_DTYPE, count=Pattern.NUMBER_OF_TRACKS)
+            lengths = tracks_values["length"].tolist()
+            steps_values = tracks_values["steps"]
+            occupied = steps_values["note"] != Note.EMPTY_VALUE
+
+            for i in range(Pattern.NUMBER_OF_TRACKS):
+                # pattern length is zero-based, actual lowest length is 1
+                tracks.append(Track(length=lengths[i] + 1, step_values=steps_values[i],
+                                    occupied_steps=numpy.flatnonzero(occupied[i]).tolist()))
+
+            return Pattern(tracks=tracks)
+
         for i in range(Pattern.NUMBER_OF_TRACKS):
 
             start_offset = i*Track.PAYLOAD_LENGTH
@@ -339,6 +816,119 @@ class Pattern:
         return Pattern(tracks=tracks)
 
 
+def pack_payload(data: bytes) -> bytes:
+    """
+    Compresses pattern or project file bytes, e.g. to send them to other processes.
+    Fastest compression level is used, since payloads are mostly the same empty steps
+    """
+    return zlib.compress(data, 1)
+
+
+def unpack_payload(data: bytes) -> bytes:
+    """Decompresses bytes compressed with pack_payload()"""
+    return zlib.decompress(data)
+
+
+# names of step values in the order they are stored in step payload
+STEP_FIELDS = ("note", "instrument", "fx2_type", "fx2_value", "fx1_type", "fx1_value")
+
+# struct format of one step payload, used when numpy is not available
+STEP_STRUCT_FORMAT = "6B"
+
+if numpy is not None:
+    STEP_DTYPE = numpy.dtype([(field, numpy.uint8) for field in STEP_FIELDS])
+    # zero-based track length byte followed by all of the steps
+    TRACK_DTYPE = numpy.dtype([("length", numpy.uint8), ("steps", STEP_DTYPE, (Track.NUMBER_OF_STEPS,))])
+else:
+    STEP_DTYPE = None
+    TRACK_DTYPE = None
+
+
+class PatternSummary:
+    """
+    Statistics of a pattern that are useful when exporting it, e.g.
+    which instruments are used and how many midi events it will produce
+    """
+
+    def __init__(self, instruments_mask: int = 0, note_count: int = 0, chord_count: int = 0,
+                 arp_count: int = 0, max_arp_density: float = 0, estimated_midi_event_count: int = 0):
+        """
+        :param instruments_mask: bitset of instruments that play notes in the pattern,
+        bit N is set if instrument N is used
+        :param note_count: number of steps that play notes (including chords and arps)
+        :param chord_count: number of steps that play chords without arpeggio
+        :param arp_count: number of steps that play arpeggios
+        :param max_arp_density: highest number of arpeggio notes per step
+        :param estimated_midi_event_count: expected number of midi note on and off events
+        """
+        self.instruments_mask = instruments_mask
+        self.note_count = note_count
+        self.chord_count = chord_count
+        self.arp_count = arp_count
+        self.max_arp_density = max_arp_density
+        self.estimated_midi_event_count = estimated_midi_event_count
+
+    @property
+    def instruments(self) -> List[int]:
+        """sorted numbers of instruments that play notes in the pattern"""
+        return [number for number in range(self.instruments_mask.bit_length())
+                if self.instruments_mask >> number & 1]
+
+    @staticmethod
+    def from_pattern(pattern: "Pattern") -> "PatternSummary":
+
+        summary = PatternSummary()
+
+        for track in pattern.tracks:
+
+            arp_stop_positions = track.get_arp_stop_positions()
+
+            for step_number, step in track.iter_occupied_steps():
+
+                if step.note.is_off_fad_or_cut():
+                    continue
+
+                summary.instruments_mask |= 1 << step.instrument_number
+                summary.note_count += 1
+
+                chord_pitches = step.get_chord_midi_pitches()
+                # arpeggio works only with chord fx at the same step
+                arp_parameters = step.get_arp_parameters() if chord_pitches else None
+
+                if arp_parameters:
+                    division = arp_parameters[1]
+                    summary.arp_count += 1
+                    summary.max_arp_density = max(summary.max_arp_density, 1 / division)
+                    # rounding gets rid of float errors for divisions like 1/3
+                    arp_notes_count = math.ceil(round((arp_stop_positions[step_number] - step_number) / division, 6))
+                    summary.estimated_midi_event_count += 2 * arp_notes_count
+
+                elif chord_pitches:
+                    summary.chord_count += 1
+                    summary.estimated_midi_event_count += 2 * len(chord_pitches)
+
+                else:
+                    summary.estimated_midi_event_count += 2
+
+        return summary
+
+    def __str__(self):
+        return (f"instruments: {self.instruments}, notes: {self.note_count}, "
+                f"chords: {self.chord_count}, arps: {self.arp_count}, "
+                f"max arp notes per step: {self.max_arp_density:g}, "
+                f"estimated midi events: {self.estimated_midi_event_count}")
+
+
+def read_file_buffer(filename: str) -> memoryview:
+    """
+    Reads the whole file at once and returns a read-only buffer over its bytes.
+    Slicing returned memoryview does not copy data, so the file is decoded
+    from views over the bytes that were read, without copying them again.
+    """
+    with open(filename, "rb") as f:
+        return memoryview(f.read())
+
+
 class PatternParser:
     """
     Parser for Polyend Tracker pattern *.mtp filtes
@@ -348,6 +938,7 @@ class PatternParser:
         self.filename = filename
 
     def parse(self) -> Pattern:
-        with open(self.filename, "rb") as f:
 
-            return Pattern.from_bytes(f.read()[Pattern.OFFSET_START:Pattern.OFFSET_END])
+        data = read_file_buffer(self.filename)
+
+        return Pattern.from_bytes(data[Pattern.OFFSET_START:Pattern.OFFSET_END])
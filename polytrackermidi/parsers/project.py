@@ -2,11 +2,76 @@
 
 __author__ = "Alexey 'DataGreed' Strelkov"
 
+import bisect
 import os
+import re
 import struct
-from typing import List, Dict
+from collections.abc import Mapping
+from typing import List, Dict, Tuple
 
-from polytrackermidi.parsers.patterns import Pattern
+from polytrackermidi.parsers.patterns import Pattern, pack_payload, read_file_buffer, unpack_payload
+
+
+class LazyPatternMapping(Mapping):
+    """
+    Read-only mapping of pattern number to Pattern that keeps
+    raw pattern file bytes and decodes every pattern only when
+    it is accessed for the first time. Patterns that are never
+    used in the song are never decoded.
+    """
+
+    def __init__(self, patterns_bytes: Dict[int, bytes]):
+        """
+        :param patterns_bytes: a dict that maps pattern number to full pattern file
+        bytes (without offsets applied). Values can be any bytes-like objects,
+        e.g. memoryviews over file bytes - patterns are decoded from views over them
+        when accessed, without copying.
+        """
+        self.patterns_bytes = patterns_bytes
+        self._patterns: Dict[int, Pattern] = {}
+
+    def __getitem__(self, pattern_number: int) -> Pattern:
+        pattern = self._patterns.get(pattern_number)
+        if pattern is None:
+            data = self.patterns_bytes[pattern_number]
+            pattern = Pattern.from_bytes(data[Pattern.OFFSET_START:Pattern.OFFSET_END])
+            self._patterns[pattern_number] = pattern
+        return pattern
+
+    def __contains__(self, pattern_number) -> bool:
+        # do not decode pattern just to check it exists
+        return pattern_number in self.patterns_bytes
+
+    def __iter__(self):
+        return iter(self.patterns_bytes)
+
+    def __len__(self):
+        return len(self.patterns_bytes)
+
+    def get_pattern_length(self, pattern_number: int) -> int:
+        """
+        Returns pattern length in steps without decoding the pattern:
+        length is the first byte of the first track payload (zero-based)
+        """
+        pattern = self._patterns.get(pattern_number)
+        if pattern is not None:
+            return pattern.tracks[0].length
+        return self.patterns_bytes[pattern_number][Pattern.OFFSET_START] + 1
+
+    def __reduce__(self):
+        # only compressed raw bytes of pattern files are pickled, decoded
+        # patterns are not, they are decoded again when accessed
+        return LazyPatternMapping.from_packed_bytes, ({pattern_number: pack_payload(data)
+                                                       for pattern_number, data in self.patterns_bytes.items()},)
+
+    @staticmethod
+    def from_packed_bytes(packed_patterns_bytes: Dict[int, bytes]) -> "LazyPatternMapping":
+        """Constructs mapping from pattern files bytes compressed with pack_payload()"""
+        return LazyPatternMapping({pattern_number: memoryview(unpack_payload(data))
+                                   for pattern_number, data in packed_patterns_bytes.items()})
+
+    def __repr__(self):
+        return f"<LazyPatternMapping patterns={sorted(self.patterns_bytes)} decoded={sorted(self._patterns)}>"
 
 
 class Song:
@@ -33,6 +98,9 @@ class Song:
         self.pattern_mapping = pattern_mapping
         self.pattern_chain = pattern_chain
 
+        # song steps at which every slot starts, see get_slot_start_steps()
+        self._slot_start_steps = None
+
         # integrity check
         for i in set(pattern_chain):
             if i not in pattern_mapping.keys():
@@ -41,11 +109,79 @@ class Song:
                                  f"Context: pattern_chain: {pattern_chain}; "
                                  f"pattern_mapping: {pattern_mapping}")
 
+    def __reduce__(self):
+        # cached slot index is not pickled, patterns pickle themselves compactly
+        return Song, (self.pattern_chain, self.pattern_mapping, self.bpm)
+
     def get_song_as_patterns(self) -> List[Pattern]:
         """Returns song as a list of patterns ordered. Play them in
         the returned order to get the song"""
         return [self.pattern_mapping[x] for x in self.pattern_chain]
 
+    def get_pattern_length(self, pattern_number: int) -> int:
+        """Returns length of the pattern in steps (without decoding pattern if possible)"""
+        if isinstance(self.pattern_mapping, LazyPatternMapping):
+            return self.pattern_mapping.get_pattern_length(pattern_number)
+        return self.pattern_mapping[pattern_number].tracks[0].length
+
+    def get_slot_start_steps(self) -> List[int]:
+        """
+        Returns song steps at which every slot starts (prefix sums of pattern lengths).
+        The list has one more item than there are slots: the last item is song length in steps.
+        Computed once, call reset_slot_index() if pattern_chain is modified.
+        """
+        if self._slot_start_steps is None:
+            slot_start_steps = [0]
+            for pattern_number in self.pattern_chain:
+                slot_start_steps.append(slot_start_steps[-1] + self.get_pattern_length(pattern_number))
+            self._slot_start_steps = slot_start_steps
+        return self._slot_start_steps
+
+    def reset_slot_index(self):
+        self._slot_start_steps = None
+
+    def get_length_in_steps(self) -> int:
+        return self.get_slot_start_steps()[-1]
+
+    def get_slot_at_step(self, song_step: int) -> Tuple[int, int]:
+        """
+        Finds the song slot that plays at the song step.
+        :param song_step: zero-based step from the start of the song
+        :return: (zero-based slot number, zero-based step within the slot pattern)
+        """
+        slot_start_steps = self.get_slot_start_steps()
+
+        if not 0 <= song_step < slot_start_steps[-1]:
+            raise IndexError(f"Song step {song_step} is out of song range 0..{slot_start_steps[-1] - 1}")
+
+        slot = bisect.bisect_right(slot_start_steps, song_step) - 1
+        return slot, song_step - slot_start_steps[slot]
+
+    def get_song_step(self, slot: int, step: int = 0) -> int:
+        """
+        :param slot: zero-based slot number
+        :param step: zero-based step within the slot pattern
+        :return: zero-based step from the start of the song
+        """
+        return self.get_slot_start_steps()[slot] + step
+
+    def get_step_duration(self) -> float:
+        """:return: duration of one step (1/16 note) in seconds"""
+        return 60 / self.bpm / 4
+
+    def get_song_step_at_time(self, seconds: float) -> int:
+        """:return: zero-based song step that is playing at the time (in seconds from the song start)"""
+        # rounding gets rid of float errors for times that are exactly at step boundaries
+        return int(round(seconds / self.get_step_duration(), 6))
+
+    def get_slot_at_time(self, seconds: float) -> Tuple[int, int]:
+        """:return: (zero-based slot number, zero-based step within the slot pattern) playing at the time"""
+        return self.get_slot_at_step(self.get_song_step_at_time(seconds))
+
+    def get_time_at_song_step(self, song_step: int) -> float:
+        """:return: time in seconds from the song start at which song step starts playing"""
+        return song_step * self.get_step_duration()
+
 
 class Project:
     """
@@ -61,6 +197,9 @@ class Project:
         self.name = name
         self.song = song
 
+    def __reduce__(self):
+        return Project, (self.name, self.song)
+
     OFFSET_END = 0x624 #1572 bytes total files length
     OFFSET_START = 0
 
@@ -74,7 +213,8 @@ class Project:
     def from_bytes(data: bytes, patterns_bytes=Dict[int,bytes]) -> "Project":
         """
         Constructs a project object from bytes extracted from project file.
-        :param data:
+        :param data: project file bytes. Can be any bytes-like object,
+        e.g. memoryview over file bytes.
         :param patterns_bytes: a list of bytes for each of projects
         patterns extracted from pattern files. Note: expects full file
         byte representation without offsets.
@@ -85,13 +225,10 @@ class Project:
         if len(data) != expected_length:
             raise ValueError(f"Expected project data {expected_length} bytes long, got {len(data)} instead")
 
-        patterns_mapping = {}
-
-        # parse patterns from received bytes for each pattern file
-        # and save them in a dict tha maps pattern number to Pattern object
-        # so it can be used later to construct a song
-        for key, value in patterns_bytes.items():
-            patterns_mapping[key] = Pattern.from_bytes(value[Pattern.OFFSET_START:Pattern.OFFSET_END])
+        # patterns are parsed from received bytes for each pattern file
+        # only when they are needed, e.g. when a song is rendered,
+        # so patterns that are not used in the song cost nothing
+        patterns_mapping = LazyPatternMapping(patterns_bytes)
 
         bpm = Project.bpm_from_bytes(data[Project.BPM_OFFSET_START:Project.BPM_OFFSET_START+Project.BPM_BYTES_LENGTH])
 
@@ -151,6 +288,8 @@ class ProjectParser:
     PATTERNS_FOLDER_NAME = "patterns"
     DEFAULT_PROJECT_FILENAME = "project.mt"
     PATTERN_FILE_NAME_TEMPLATE = "pattern_{}.mtp"   # todo: format: add leading zero automatically
+    # pattern files go as pattern_01.mtp ... pattern_99.mtp, pattern_100.mtp ... pattern_255.mtp
+    PATTERN_FILE_NAME_REGEX = re.compile(r"^pattern_(0[1-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.mtp$")
 
     MAXIMUM_PATTERNS_PER_PROJECT = 255  # from polyend docs
 
@@ -173,36 +312,48 @@ class ProjectParser:
 
         self.patterns_folder = self.folder + self.PATTERNS_FOLDER_NAME + os.sep
 
-    def parse(self) -> Project:
+        # number of file system calls made by the last parse() call
+        self.io_stats: Dict[str, int] = {"scandir": 0, "open": 0}
 
-        project_file_bytes = None
-        pattern_file_bytes_dict: Dict[int, bytes] = {}
+    def find_pattern_files(self) -> Dict[int, str]:
+        """
+        Lists patterns folder once and returns a dict that maps
+        pattern numbers to paths of pattern files that actually exist.
+        """
+        pattern_files: Dict[int, str] = {}
 
-        with open(self.filepath, "rb") as f:
-            project_file_bytes = f.read()  # f.read()[Project.OFFSET_START:Project.OFFSET_END]
+        self.io_stats["scandir"] += 1
+        try:
+            entries = list(os.scandir(self.patterns_folder))
+        except FileNotFoundError:
+            # it's okay. Project may have no patterns at all.
+            return pattern_files
 
-        # find all project pattern files and add their bytes to the parser too
-        for i in range(1, self.MAXIMUM_PATTERNS_PER_PROJECT+1):
-            pattern_file_path = self.patterns_folder+self.PATTERN_FILE_NAME_TEMPLATE
+        for entry in entries:
+            match = self.PATTERN_FILE_NAME_REGEX.match(entry.name)
+            if match and entry.is_file():
+                number = int(match.group(1))
+                pattern_files[number] = entry.path
 
-            # FIXME: patterns names goe as pattern_01.mtp, but manual says there can be
-            #  255 patterns, how pattern 100 file will be named if
-            #  there is only 1 leading zero in one digit projects?
+        return dict(sorted(pattern_files.items()))
 
-            # answer: it looks like that: pattern_255.mtp
+    def parse(self) -> Project:
+
+        pattern_file_bytes_dict: Dict[int, bytes] = {}
 
-            pattern_number_string = str(i)
-            if len(pattern_number_string) < 2:
-                pattern_number_string = "0" + pattern_number_string
+        # count file system calls so the cost of parsing
+        # on slow mounts (SD cards, network shares) can be checked
+        self.io_stats = {"scandir": 0, "open": 0}
 
-            pattern_file_path = pattern_file_path.replace("{}", pattern_number_string)
+        # every file is read once, patterns and project values are decoded
+        # from views over the read bytes without copying them
+        self.io_stats["open"] += 1
+        project_file_bytes = read_file_buffer(self.filepath)
 
-            try:
-                with open(pattern_file_path, "rb") as f:
-                    # pattern
-                    pattern_file_bytes_dict[i] = f.read()   # reads the whole file
-            except FileNotFoundError as e:
-                # it's okay. Not all patterns have to exist.
-                pass
+        # find all project pattern files and add their bytes to the parser too.
+        # Not all patterns have to exist, so only existing files are opened
+        for number, pattern_file_path in self.find_pattern_files().items():
+            self.io_stats["open"] += 1
+            pattern_file_bytes_dict[number] = read_file_buffer(pattern_file_path)   # the whole file
 
         return Project.from_bytes(project_file_bytes, pattern_file_bytes_dict)
@@ -16,6 +16,8 @@ setup(
     # py_modules = ['polytrackermidi'],
     packages = find_packages(),
     install_requires = [requirements],
+    # numpy is optional, it speeds up decoding of pattern files
+    extras_require = {'numpy': ['numpy']},
     python_requires='>=3.7',
     classifiers=[
         "Programming Language :: Python :: 3.9",